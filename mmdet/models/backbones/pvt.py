@@ -90,9 +90,10 @@ class MixFFN(BaseModule):
             dropout_layer) if dropout_layer else torch.nn.Identity()
 
     def forward(self, x, hw_shape, identity=None):
-        out = nlc_to_nchw(x, hw_shape)
+        # the convs accept the `channels_last` view of `x` without a copy
+        out = nlc_to_nchw(x, hw_shape, contiguous=False)
         out = self.layers(out)
-        out = nchw_to_nlc(out)
+        out = nchw_to_nlc(out, contiguous=False)
         if identity is None:
             identity = x
         return identity + self.dropout_layer(out)
@@ -169,9 +170,9 @@ class SpatialReductionAttention(MultiheadAttention):
 
         x_q = x
         if self.sr_ratio > 1:
-            x_kv = nlc_to_nchw(x, hw_shape)
+            x_kv = nlc_to_nchw(x, hw_shape, contiguous=False)
             x_kv = self.sr(x_kv)
-            x_kv = nchw_to_nlc(x_kv)
+            x_kv = nchw_to_nlc(x_kv, contiguous=False)
             x_kv = self.norm(x_kv)
         else:
             x_kv = x
@@ -200,9 +201,9 @@ class SpatialReductionAttention(MultiheadAttention):
         """multi head attention forward in mmcv version < 1.3.17."""
         x_q = x
         if self.sr_ratio > 1:
-            x_kv = nlc_to_nchw(x, hw_shape)
+            x_kv = nlc_to_nchw(x, hw_shape, contiguous=False)
             x_kv = self.sr(x_kv)
-            x_kv = nchw_to_nlc(x_kv)
+            x_kv = nchw_to_nlc(x_kv, contiguous=False)
             x_kv = self.norm(x_kv)
         else:
             x_kv = x
@@ -1,5 +1,7 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import copy
+import functools
+import inspect
 import math
 from tkinter import N
 import warnings
@@ -28,6 +30,7 @@ from mmcv.cnn.bricks.transformer import (
     build_feedforward_network,
     build_transformer_layer_sequence,
 )
+from mmcv.runner import auto_fp16
 from mmcv.runner.base_module import BaseModule, ModuleList
 from mmcv.utils import to_2tuple
 from torch.nn.init import normal_
@@ -45,12 +48,38 @@ except ImportError:
     from mmcv.cnn.bricks.transformer import MultiScaleDeformableAttention
 
 
-def nlc_to_nchw(x, hw_shape):
+def _import_top_p_sampling():
+    """Import the fused top-p sampling kernel of `flashinfer>=0.2`.
+
+    Returns:
+        callable | None: `flashinfer.sampling.top_p_sampling_from_probs`, or
+            None if `flashinfer` is not installed or is older than 0.2.
+    """
+    try:
+        from flashinfer.sampling import top_p_sampling_from_probs
+    except ImportError:
+        return None
+    # flashinfer<0.2 takes pre-drawn `uniform_samples` before `top_p` and
+    # returns a (samples, success) tuple, fall back to torch for it
+    if "uniform_samples" in inspect.signature(
+            top_p_sampling_from_probs).parameters:
+        return None
+    return top_p_sampling_from_probs
+
+
+top_p_sampling_from_probs = _import_top_p_sampling()
+
+
+def nlc_to_nchw(x, hw_shape, contiguous=True):
     """Convert [N, L, C] shape tensor to [N, C, H, W] shape tensor.
 
     Args:
         x (Tensor): The input tensor of shape [N, L, C] before conversion.
         hw_shape (Sequence[int]): The height and width of output feature map.
+        contiguous (bool): Whether to return a contiguous tensor. If False,
+            a view in `channels_last` layout is returned without copying,
+            which is fine for consumers such as convolutions.
+            Default: True.
 
     Returns:
         Tensor: The output tensor of shape [N, C, H, W] after conversion.
@@ -59,20 +88,60 @@ def nlc_to_nchw(x, hw_shape):
     assert len(x.shape) == 3
     B, L, C = x.shape
     assert L == H * W, "The seq_len does not match H, W"
-    return x.transpose(1, 2).reshape(B, C, H, W).contiguous()
+    x = x.transpose(1, 2).reshape(B, C, H, W)
+    return x.contiguous() if contiguous else x
 
 
-def nchw_to_nlc(x):
+def nchw_to_nlc(x, contiguous=True):
     """Flatten [N, C, H, W] shape tensor to [N, L, C] shape tensor.
 
     Args:
         x (Tensor): The input tensor of shape [N, C, H, W] before conversion.
+        contiguous (bool): Whether to return a contiguous tensor. If False,
+            the transposed view is returned, which is already contiguous
+            when `x` is in `channels_last` layout. Default: True.
 
     Returns:
         Tensor: The output tensor of shape [N, L, C] after conversion.
     """
     assert len(x.shape) == 4
-    return x.flatten(2).transpose(1, 2).contiguous()
+    x = x.flatten(2).transpose(1, 2)
+    return x.contiguous() if contiguous else x
+
+
+def nchw_to_lnc(x):
+    """Convert [N, C, H, W] shape tensor to [H*W, N, C] shape tensor.
+
+    The permuted result is materialized in a single copy, so that the
+    sequence-first layers consuming it work on contiguous memory.
+
+    Args:
+        x (Tensor): The input tensor of shape [N, C, H, W] before conversion.
+
+    Returns:
+        Tensor: The output tensor of shape [H*W, N, C] after conversion.
+    """
+    assert len(x.shape) == 4
+    N, C = x.shape[:2]
+    # use `view` instead of `flatten` for dynamically exporting to ONNX
+    return x.view(N, C, -1).permute(2, 0, 1).contiguous()
+
+
+@functools.lru_cache(maxsize=16)
+def _adaptive_pad_shape(input_shape, kernel_size, stride, dilation):
+    """Compute the padding needed by :class:`AdaptivePadding`."""
+    input_h, input_w = input_shape
+    kernel_h, kernel_w = kernel_size
+    stride_h, stride_w = stride
+    output_h = (input_h + stride_h - 1) // stride_h
+    output_w = (input_w + stride_w - 1) // stride_w
+    pad_h = max(
+        (output_h - 1) * stride_h + (kernel_h - 1) * dilation[0] + 1 - input_h,
+        0)
+    pad_w = max(
+        (output_w - 1) * stride_w + (kernel_w - 1) * dilation[1] + 1 - input_w,
+        0)
+    return pad_h, pad_w
 
 
 class AdaptivePadding(nn.Module):
@@ -123,22 +192,10 @@ class AdaptivePadding(nn.Module):
         self.dilation = dilation
 
     def get_pad_shape(self, input_shape):
-        input_h, input_w = input_shape
-        kernel_h, kernel_w = self.kernel_size
-        stride_h, stride_w = self.stride
-        output_h = math.ceil(input_h / stride_h)
-        output_w = math.ceil(input_w / stride_w)
-        pad_h = max(
-            (output_h - 1) * stride_h + (kernel_h - 1) *
-            self.dilation[0] + 1 - input_h,
-            0,
-        )
-        pad_w = max(
-            (output_w - 1) * stride_w + (kernel_w - 1) *
-            self.dilation[1] + 1 - input_w,
-            0,
-        )
-        return pad_h, pad_w
+        # the pad shape only depends on the input size, which rarely
+        # changes between iterations
+        return _adaptive_pad_shape(
+            tuple(input_shape), self.kernel_size, self.stride, self.dilation)
 
     def forward(self, x):
         pad_h, pad_w = self.get_pad_shape(x.size()[-2:])
@@ -229,6 +286,15 @@ class PatchEmbed(BaseModule):
             bias=bias,
         )
 
+        # symmetric "same" padding can be done by the conv itself, which
+        # saves writing a padded copy of the input
+        self.fuse_padding = (
+            self.adap_padding is not None
+            and self.adap_padding.padding == "same"
+            and type(self.projection) is nn.Conv2d
+            and self.projection.padding_mode == "zeros"
+        )
+
         if norm_cfg is not None:
             self.norm = build_norm_layer(norm_cfg, embed_dims)[1]
         else:
@@ -275,9 +341,25 @@ class PatchEmbed(BaseModule):
         """
 
         if self.adap_padding:
-            x = self.adap_padding(x)
-
-        x = self.projection(x)
+            pad_h, pad_w = self.adap_padding.get_pad_shape(x.shape[-2:])
+            # the conv is called functionally, only when no hook of the
+            # projection would be skipped by it
+            if (self.fuse_padding and pad_h % 2 == 0 and pad_w % 2 == 0
+                    and not self.projection._forward_pre_hooks
+                    and not self.projection._forward_hooks):
+                x = F.conv2d(
+                    x,
+                    self.projection.weight,
+                    self.projection.bias,
+                    self.projection.stride,
+                    (pad_h // 2, pad_w // 2),
+                    self.projection.dilation,
+                    self.projection.groups,
+                )
+            else:
+                x = self.projection(self.adap_padding(x))
+        else:
+            x = self.projection(x)
         out_size = (x.shape[2], x.shape[3])
         x = x.flatten(2).transpose(1, 2)
         if self.norm is not None:
@@ -356,6 +438,10 @@ class PatchMerging(BaseModule):
         self.sampler = nn.Unfold(
             kernel_size=kernel_size, dilation=dilation, padding=padding, stride=stride
         )
+        # non-overlapping windows can be merged by a reshape instead of unfold
+        self.non_overlapping = (
+            stride == kernel_size and dilation == (1, 1) and padding == (0, 0)
+        )
 
         sample_dim = kernel_size[0] * kernel_size[1] * in_channels
 
@@ -396,30 +482,41 @@ class PatchMerging(BaseModule):
             x = self.adap_padding(x)
             H, W = x.shape[-2:]
 
-        x = self.sampler(x)
-        # if kernel_size=2 and stride=2, x should has shape (B, 4*C, H/2*W/2)
-
-        out_h = (
-            H
-            + 2 * self.sampler.padding[0]
-            - self.sampler.dilation[0] * (self.sampler.kernel_size[0] - 1)
-            - 1
-        ) // self.sampler.stride[0] + 1
-        out_w = (
-            W
-            + 2 * self.sampler.padding[1]
-            - self.sampler.dilation[1] * (self.sampler.kernel_size[1] - 1)
-            - 1
-        ) // self.sampler.stride[1] + 1
+        kernel_h, kernel_w = self.sampler.kernel_size
+        if self.non_overlapping and H % kernel_h == 0 and W % kernel_w == 0:
+            # Non-overlapping windows can be gathered with a reshape, which
+            # avoids the intermediate buffer of `nn.Unfold`. The channels are
+            # arranged as (C, kernel_h, kernel_w), the same as `nn.Unfold`.
+            out_h, out_w = H // kernel_h, W // kernel_w
+            x = x.reshape(B, C, out_h, kernel_h, out_w, kernel_w)
+            x = x.permute(0, 2, 4, 1, 3, 5).reshape(
+                B, out_h * out_w, C * kernel_h * kernel_w)
+        else:
+            x = self.sampler(x)
+            # if kernel_size=2 and stride=2, x should has shape
+            # (B, 4*C, H/2*W/2)
+            x = x.transpose(1, 2)  # B, H/2*W/2, 4*C
+
+            out_h = (
+                H
+                + 2 * self.sampler.padding[0]
+                - self.sampler.dilation[0] * (self.sampler.kernel_size[0] - 1)
+                - 1
+            ) // self.sampler.stride[0] + 1
+            out_w = (
+                W
+                + 2 * self.sampler.padding[1]
+                - self.sampler.dilation[1] * (self.sampler.kernel_size[1] - 1)
+                - 1
+            ) // self.sampler.stride[1] + 1
 
         output_size = (out_h, out_w)
-        x = x.transpose(1, 2)  # B, H/2*W/2, 4*C
         x = self.norm(x) if self.norm else x
         x = self.reduction(x)
         return x, output_size
 
 
-def inverse_sigmoid(x, eps=1e-5):
+def inverse_sigmoid(x, eps: float = 1e-5):
     """Inverse function of sigmoid.
 
     Args:
@@ -432,12 +529,64 @@ def inverse_sigmoid(x, eps=1e-5):
             function of sigmoid, has same
             shape with input.
     """
-    x = x.clamp(min=0, max=1)
-    x1 = x.clamp(min=eps)
-    x2 = (1 - x).clamp(min=eps)
+    # same as clamping `x` to [0, 1] first, without the extra kernel
+    x1 = x.clamp(min=eps, max=1)
+    x2 = (1 - x).clamp(min=eps, max=1)
     return torch.log(x1 / x2)
 
 
+@torch.jit.script
+def refine_reference_points(delta, reference_points):
+    """Refine the normalized reference points with the predicted offsets.
+
+    The offsets are added in the inverse sigmoid space. It is scripted so
+    that the chain of element-wise ops can be fused.
+
+    Args:
+        delta (Tensor): The predicted offsets, has shape (bs, num_query, 4).
+        reference_points (Tensor): The reference points, has shape
+            (bs, num_query, 4) or (bs, num_query, 2). For the latter, only
+            the first two channels of `delta` are offsets.
+
+    Returns:
+        Tensor: The refined reference points, has same shape with `delta`.
+    """
+    if reference_points.size(-1) == 4:
+        return (delta + inverse_sigmoid(reference_points)).sigmoid()
+    assert reference_points.size(-1) == 2
+    return torch.cat(
+        [delta[..., :2] + inverse_sigmoid(reference_points), delta[..., 2:]], -1
+    ).sigmoid()
+
+
+@torch.jit.script
+def mask_encoder_output_proposals(memory, memory_padding_mask, proposals):
+    """Mask the padded tokens and out-of-range proposals of the encoder.
+
+    It is scripted so that the chain of element-wise ops can be fused.
+
+    Args:
+        memory (Tensor): The output of encoder, has shape
+            (bs, num_key, embed_dim).
+        memory_padding_mask (Tensor): Padding mask for memory, has shape
+            (bs, num_key).
+        proposals (Tensor): The normalized proposals, has shape
+            (bs, num_key, 4).
+
+    Returns:
+        tuple[Tensor]: The masked memory, and the proposals after an inverse
+            sigmoid with the masked ones set to inf.
+    """
+    # reduce the 4 coordinates first instead of comparing all of them
+    valid = (proposals.min(-1, keepdim=True)[0] > 0.01) & (
+        proposals.max(-1, keepdim=True)[0] < 0.99)
+    invalid = memory_padding_mask.unsqueeze(-1) | ~valid
+    proposals = torch.log(proposals / (1 - proposals))
+    proposals = proposals.masked_fill(invalid, float("inf"))
+    memory = memory.masked_fill(invalid, 0.0)
+    return memory, proposals
+
+
 @TRANSFORMER_LAYER.register_module()
 class DetrTransformerDecoderLayer(BaseTransformerLayer):
     """Implements decoder layer in DETR transformer.
@@ -563,15 +712,19 @@ class DetrTransformerDecoder(TransformerLayerSequence):
             if self.post_norm:
                 x = self.post_norm(x)[None]
             return x
-        intermediate = []
-        for layer in self.layers:
+        # write each layer's output into one preallocated tensor instead of
+        # stacking a list of them at the end
+        intermediate = None
+        for lid, layer in enumerate(self.layers):
             query = layer(query, *args, **kwargs)
-            if self.return_intermediate:
-                if self.post_norm is not None:
-                    intermediate.append(self.post_norm(query))
-                else:
-                    intermediate.append(query)
-        return torch.stack(intermediate)
+            if intermediate is None:
+                intermediate = query.new_empty(
+                    (self.num_layers, ) + query.shape)
+            intermediate[lid] = query
+        # the norm only acts on the last dim, normalize all layers at once
+        if self.post_norm is not None:
+            intermediate = self.post_norm(intermediate)
+        return intermediate
 
 
 @TRANSFORMER.register_module()
@@ -602,6 +755,7 @@ class Transformer(BaseModule):
         self.encoder = build_transformer_layer_sequence(encoder)
         self.decoder = build_transformer_layer_sequence(decoder)
         self.embed_dims = self.encoder.embed_dims
+        self.fp16_enabled = False
 
     def init_weights(self):
         # follow the official DETR to init parameters
@@ -610,6 +764,7 @@ class Transformer(BaseModule):
                 xavier_init(m, distribution="uniform")
         self._is_init = True
 
+    @auto_fp16(apply_to=("x", "pos_embed"), out_fp32=True)
     def forward(self, x, mask, query_embed, pos_embed):
         """Forward function for `Transformer`.
 
@@ -634,12 +789,11 @@ class Transformer(BaseModule):
                       [bs, embed_dims, h, w].
         """
         bs, c, h, w = x.shape
-        # use `view` instead of `flatten` for dynamically exporting to ONNX
-        x = x.view(bs, c, -1).permute(2, 0, 1)  # [bs, c, h, w] -> [h*w, bs, c]
-        pos_embed = pos_embed.view(bs, c, -1).permute(2, 0, 1)
-        query_embed = query_embed.unsqueeze(1).repeat(
-            1, bs, 1
-        )  # [num_query, dim] -> [num_query, bs, dim]
+        x = nchw_to_lnc(x)  # [bs, c, h, w] -> [h*w, bs, c]
+        pos_embed = nchw_to_lnc(pos_embed)
+        # the queries are the same for all images, broadcast them without
+        # copying, [num_query, dim] -> [num_query, bs, dim]
+        query_embed = query_embed.unsqueeze(1).expand(-1, bs, -1)
         mask = mask.view(bs, -1)  # [bs, h, w] -> [bs, h*w]
         memory = self.encoder(
             query=x,
@@ -648,7 +802,8 @@ class Transformer(BaseModule):
             query_pos=pos_embed,
             query_key_padding_mask=mask,
         )
-        target = torch.zeros_like(query_embed)
+        target = query_embed.new_zeros((query_embed.size(0), 1, c)).expand(
+            -1, bs, -1)
         # out_dec: [num_layers, num_query, bs, dim]
         out_dec = self.decoder(
             query=target,
@@ -659,6 +814,9 @@ class Transformer(BaseModule):
             key_padding_mask=mask,
         )
         out_dec = out_dec.transpose(1, 2)
+        # splitting the last dim of the permuted view is itself a view, so
+        # the memory is returned as a strided [bs, c, h, w] tensor without
+        # any copy; consumers that need a dense layout can materialize it
         memory = memory.permute(1, 2, 0).reshape(bs, c, h, w)
         return out_dec, memory
 
@@ -710,50 +868,204 @@ class DeformableDetrTransformerDecoder(TransformerLayerSequence):
                 [num_layers, num_query, bs, embed_dims].
         """
         output = query
-        intermediate = []
-        intermediate_reference_points = []
+        intermediate = None
+        intermediate_reference_points = None
+        # `valid_ratios` is the same for all layers
+        valid_ratios_2d = valid_ratios[:, None]
+        valid_ratios_4d = torch.cat([valid_ratios, valid_ratios], -1)[:, None]
         for lid, layer in enumerate(self.layers):
             if reference_points.shape[-1] == 4:
                 reference_points_input = (
-                    reference_points[:, :, None]
-                    * torch.cat([valid_ratios, valid_ratios], -1)[:, None]
+                    reference_points[:, :, None] * valid_ratios_4d
                 )
             else:
                 assert reference_points.shape[-1] == 2
                 reference_points_input = (
-                    reference_points[:, :, None] * valid_ratios[:, None]
+                    reference_points[:, :, None] * valid_ratios_2d
                 )
             output = layer(
                 output, *args, reference_points=reference_points_input, **kwargs
             )
-            output = output.permute(1, 0, 2)
 
             if reg_branches is not None:
-                tmp = reg_branches[lid](output)
-                if reference_points.shape[-1] == 4:
-                    new_reference_points = tmp + \
-                        inverse_sigmoid(reference_points)
-                    new_reference_points = new_reference_points.sigmoid()
-                else:
-                    assert reference_points.shape[-1] == 2
-                    new_reference_points = tmp
-                    new_reference_points[..., :2] = tmp[..., :2] + inverse_sigmoid(
-                        reference_points
-                    )
-                    new_reference_points = new_reference_points.sigmoid()
-                reference_points = new_reference_points.detach()
+                # The refined reference points are detached, so neither the
+                # reg branch nor the update needs an autograd graph here.
+                with torch.no_grad():
+                    # `output` is [num_query, bs, dim], transpose only the
+                    # small [num_query, bs, 2 or 4] prediction to batch first
+                    tmp = reg_branches[lid](output).permute(1, 0, 2)
+                    # keep the inverse sigmoid in fp32 for numerical
+                    # stability when running with mixed precision
+                    reference_points = refine_reference_points(
+                        tmp.float(), reference_points.float())
 
-            output = output.permute(1, 0, 2)
             if self.return_intermediate:
-                intermediate.append(output)
-                intermediate_reference_points.append(reference_points)
+                if intermediate is None:
+                    intermediate = output.new_empty(
+                        (self.num_layers, ) + output.shape)
+                    intermediate_reference_points = reference_points.new_empty(
+                        (self.num_layers, ) + reference_points.shape)
+                intermediate[lid] = output
+                intermediate_reference_points[lid] = reference_points
 
         if self.return_intermediate:
-            return torch.stack(intermediate), torch.stack(intermediate_reference_points)
+            return intermediate, intermediate_reference_points
 
         return output, reference_points
 
 
+@functools.lru_cache(maxsize=16)
+def _level_ids(spatial_shapes, device):
+    """Level index of every token of the flattened multi-level features.
+
+    Args:
+        spatial_shapes (tuple[tuple[int]]): The (H, W) of each level.
+        device (torch.device): The device of the returned tensor.
+
+    Returns:
+        Tensor: The level indices with shape (sum(H*W), ).
+    """
+    counts = torch.tensor([H * W for H, W in spatial_shapes])
+    level_ids = torch.repeat_interleave(torch.arange(len(counts)), counts)
+    return level_ids.to(device)
+
+
+@functools.lru_cache(maxsize=32)
+def _base_grid(H, W, device):
+    """Centers of the pixels of a feature map.
+
+    The returned tensor is shared between calls and must not be modified
+    in place.
+
+    Args:
+        H (int): The height of the feature map.
+        W (int): The width of the feature map.
+        device (torch.device): The device of the returned tensor.
+
+    Returns:
+        Tensor: The (x + 0.5, y + 0.5) of every pixel in row-major order,
+            has shape (H*W, 2).
+    """
+    grid_y, grid_x = torch.meshgrid(
+        torch.arange(H, dtype=torch.float32, device=device),
+        torch.arange(W, dtype=torch.float32, device=device),
+    )
+    return torch.stack((grid_x, grid_y), -1).view(-1, 2) + 0.5
+
+
+@functools.lru_cache(maxsize=16)
+def _normalized_grid(spatial_shapes, device):
+    """Pixel centers of all levels normalized by the size of their level.
+
+    The returned tensor is shared between calls and must not be modified
+    in place.
+
+    Args:
+        spatial_shapes (tuple[tuple[int]]): The (H, W) of each level.
+        device (torch.device): The device of the returned tensor.
+
+    Returns:
+        Tensor: The normalized (x, y) of every token, has shape
+            (sum(H*W), 2).
+    """
+    grids = []
+    for H, W in spatial_shapes:
+        grid = _base_grid(H, W, device)
+        grids.append(grid / grid.new_tensor([W, H]))
+    return torch.cat(grids)
+
+
+@functools.lru_cache(maxsize=16)
+def _proposal_grids(spatial_shapes, device):
+    """Pixel centers and proposal sizes of all levels, concatenated.
+
+    The returned tensors are shared between calls and must not be modified
+    in place.
+
+    Args:
+        spatial_shapes (tuple[tuple[int]]): The (H, W) of each level.
+        device (torch.device): The device of the returned tensors.
+
+    Returns:
+        tuple[Tensor]: The pixel centers and the (w, h) of the proposal
+            of every token, both have shape (sum(H*W), 2).
+    """
+    grids, whs = [], []
+    for lvl, (H, W) in enumerate(spatial_shapes):
+        grid = _base_grid(H, W, device)
+        grids.append(grid)
+        whs.append(torch.full_like(grid, 0.05 * (2.0 ** lvl)))
+    return torch.cat(grids), torch.cat(whs)
+
+
+@functools.lru_cache(maxsize=8)
+def _proposal_dim_t(num_pos_feats, temperature, device):
+    """Frequencies of the sine position embedding of proposals.
+
+    Each frequency is shared by a (sin, cos) pair of features, so only
+    `num_pos_feats // 2` of them are returned.
+    """
+    dim_t = torch.arange(
+        0, num_pos_feats, 2, dtype=torch.float32, device=device)
+    return temperature ** (dim_t / num_pos_feats)
+
+
+@functools.lru_cache(maxsize=16)
+def _valid_wh_index(spatial_shapes, device):
+    """Indices used by :meth:`DeformableDetrTransformer.get_valid_wh`.
+
+    Args:
+        spatial_shapes (tuple[tuple[int]]): The (H, W) of each level.
+        device (torch.device): The device of the returned tensors.
+
+    Returns:
+        tuple[Tensor]: The token indices of the first row and the first
+            column of every level, and the (axis, level) slot each of them
+            is summed into.
+    """
+    num_levels = len(spatial_shapes)
+    index, slot = [], []
+    start = 0
+    for lvl, (H, W) in enumerate(spatial_shapes):
+        index.extend(range(start, start + W))
+        slot.extend([lvl] * W)
+        index.extend(range(start, start + H * W, W))
+        slot.extend([num_levels + lvl] * H)
+        start += H * W
+    index = torch.as_tensor(index, dtype=torch.long, device=device)
+    slot = torch.as_tensor(slot, dtype=torch.long, device=device)
+    return index, slot
+
+
+@functools.lru_cache(maxsize=16)
+def _level_wh(spatial_shapes, device):
+    """The (W, H) of each level as a float tensor of shape (num_levels, 2)."""
+    return torch.tensor(
+        [(W, H) for H, W in spatial_shapes], dtype=torch.float32,
+        device=device)
+
+
+@functools.lru_cache(maxsize=16)
+def _spatial_shape_tensors(spatial_shapes, device):
+    """The `spatial_shapes` and `level_start_index` of deformable attention.
+
+    Args:
+        spatial_shapes (tuple[tuple[int]]): The (H, W) of each level.
+        device (torch.device): The device of the returned tensors.
+
+    Returns:
+        tuple[Tensor]: The spatial shapes with shape (num_levels, 2) and the
+            start index of each level with shape (num_levels, ).
+    """
+    level_start_index = [0]
+    for H, W in spatial_shapes[:-1]:
+        level_start_index.append(level_start_index[-1] + H * W)
+    return (
+        torch.as_tensor(spatial_shapes, dtype=torch.long, device=device),
+        torch.as_tensor(level_start_index, dtype=torch.long, device=device),
+    )
+
+
 @TRANSFORMER.register_module()
 class DeformableDetrTransformer(Transformer):
     """Implements the DeformableDETR transformer.
@@ -778,13 +1090,12 @@ class DeformableDetrTransformer(Transformer):
         self.as_two_stage = as_two_stage
         self.num_feature_levels = num_feature_levels
         self.two_stage_num_proposals = two_stage_num_proposals
-        self.embed_dims = self.encoder.embed_dims
         self.init_layers()
 
     def init_layers(self):
         """Initialize layers of the DeformableDetrTransformer."""
         self.level_embeds = nn.Parameter(
-            torch.Tensor(self.num_feature_levels, self.embed_dims)
+            torch.empty(self.num_feature_levels, self.embed_dims)
         )
 
         if self.as_two_stage:
@@ -819,8 +1130,9 @@ class DeformableDetrTransformer(Transformer):
                 all level.
             memory_padding_mask (Tensor): Padding mask for memory.
                 has shape (bs, num_key).
-            spatial_shapes (Tensor): The shape of all feature maps.
-                has shape (num_level, 2).
+            spatial_shapes (Tensor | Sequence[tuple[int]]): The shape of all
+                feature maps. has shape (num_level, 2). Python ints avoid
+                synchronizing with the device.
 
         Returns:
             tuple: A tuple of feature map and bbox prediction.
@@ -835,49 +1147,17 @@ class DeformableDetrTransformer(Transformer):
         """
 
         N, S, C = memory.shape
-        proposals = []
-        _cur = 0
-        for lvl, (H, W) in enumerate(spatial_shapes):
-            mask_flatten_ = memory_padding_mask[:, _cur: (_cur + H * W)].view(
-                N, H, W, 1
-            )
-            valid_H = torch.sum(~mask_flatten_[:, :, 0, 0], 1)
-            valid_W = torch.sum(~mask_flatten_[:, 0, :, 0], 1)
-
-            grid_y, grid_x = torch.meshgrid(
-                torch.linspace(0, H - 1, H, dtype=torch.float32,
-                               device=memory.device),
-                torch.linspace(0, W - 1, W, dtype=torch.float32,
-                               device=memory.device),
-            )
-            grid = torch.cat([grid_x.unsqueeze(-1), grid_y.unsqueeze(-1)], -1)
-
-            scale = torch.cat([valid_W.unsqueeze(-1), valid_H.unsqueeze(-1)], 1).view(
-                N, 1, 1, 2
-            )
-            grid = (grid.unsqueeze(0).expand(N, -1, -1, -1) + 0.5) / scale
-            wh = torch.ones_like(grid) * 0.05 * (2.0 ** lvl)
-            proposal = torch.cat((grid, wh), -1).view(N, -1, 4)
-            proposals.append(proposal)
-            _cur += H * W
-        output_proposals = torch.cat(proposals, 1)
-        output_proposals_valid = (
-            (output_proposals > 0.01) & (output_proposals < 0.99)
-        ).all(-1, keepdim=True)
-        output_proposals = torch.log(output_proposals / (1 - output_proposals))
-        output_proposals = output_proposals.masked_fill(
-            memory_padding_mask.unsqueeze(-1), float("inf")
-        )
-        output_proposals = output_proposals.masked_fill(
-            ~output_proposals_valid, float("inf")
-        )
-
-        output_memory = memory
-        output_memory = output_memory.masked_fill(
-            memory_padding_mask.unsqueeze(-1), float(0)
-        )
-        output_memory = output_memory.masked_fill(
-            ~output_proposals_valid, float(0))
+        spatial_shapes = tuple((int(H), int(W)) for H, W in spatial_shapes)
+        valid_wh = self.get_valid_wh(memory_padding_mask, spatial_shapes)
+        # build the proposals of all levels at once, the grids and sizes only
+        # depend on the spatial shapes and are cached
+        grid, wh = _proposal_grids(spatial_shapes, memory.device)
+        level_ids = _level_ids(spatial_shapes, memory.device)
+        output_proposals = torch.cat(
+            (grid / valid_wh[:, level_ids], wh.expand(N, -1, -1)), -1)
+        # padded tokens and out-of-range proposals are masked in one pass
+        output_memory, output_proposals = mask_encoder_output_proposals(
+            memory, memory_padding_mask, output_proposals)
         output_memory = self.enc_output_norm(self.enc_output(output_memory))
         return output_memory, output_proposals
 
@@ -886,7 +1166,7 @@ class DeformableDetrTransformer(Transformer):
         """Get the reference points used in decoder.
 
         Args:
-            spatial_shapes (Tensor): The shape of all
+            spatial_shapes (Tensor | Sequence[tuple[int]]): The shape of all
                 feature maps, has shape (num_level, 2).
             valid_ratios (Tensor): The radios of valid
                 points on the feature map, has shape
@@ -898,25 +1178,41 @@ class DeformableDetrTransformer(Transformer):
             Tensor: reference points used in decoder, has \
                 shape (bs, num_keys, num_levels, 2).
         """
-        reference_points_list = []
-        for lvl, (H, W) in enumerate(spatial_shapes):
-            #  TODO  check this 0.5
-            ref_y, ref_x = torch.meshgrid(
-                torch.linspace(0.5, H - 0.5, H,
-                               dtype=torch.float32, device=device),
-                torch.linspace(0.5, W - 0.5, W,
-                               dtype=torch.float32, device=device),
-            )
-            ref_y = ref_y.reshape(-1)[None] / \
-                (valid_ratios[:, None, lvl, 1] * H)
-            ref_x = ref_x.reshape(-1)[None] / \
-                (valid_ratios[:, None, lvl, 0] * W)
-            ref = torch.stack((ref_x, ref_y), -1)
-            reference_points_list.append(ref)
-        reference_points = torch.cat(reference_points_list, 1)
+        #  TODO  check this 0.5
+        spatial_shapes = tuple((int(H), int(W)) for H, W in spatial_shapes)
+        # the normalized pixel centers of all levels are built once per
+        # shapes, only the division by the valid ratios depends on the batch
+        grid = _normalized_grid(spatial_shapes, device)
+        level_ids = _level_ids(spatial_shapes, device)
+        reference_points = grid[None] / valid_ratios[:, level_ids]
         reference_points = reference_points[:, :, None] * valid_ratios[:, None]
         return reference_points
 
+    @staticmethod
+    def get_valid_wh(memory_padding_mask, spatial_shapes):
+        """Count the valid columns and rows of the feature maps of all levels.
+
+        Args:
+            memory_padding_mask (Tensor): Padding mask of the flattened
+                feature maps, has shape (bs, num_keys).
+            spatial_shapes (Tensor | Sequence[tuple[int]]): The shape of
+                all feature maps, has shape (num_level, 2).
+
+        Returns:
+            Tensor: The number of valid columns and rows, has shape \
+                (bs, num_levels, 2).
+        """
+        spatial_shapes = tuple((int(H), int(W)) for H, W in spatial_shapes)
+        num_levels = len(spatial_shapes)
+        # Gather the first row and the first column of every level at once
+        # and sum each of them into its own (axis, level) slot.
+        index, slot = _valid_wh_index(
+            spatial_shapes, memory_padding_mask.device)
+        valid = (~memory_padding_mask.index_select(1, index)).float()
+        valid_wh = valid.new_zeros((valid.size(0), 2 * num_levels))
+        valid_wh.index_add_(1, slot, valid)
+        return valid_wh.view(-1, 2, num_levels).transpose(1, 2)
+
     def get_valid_ratio(self, mask):
         """Get the valid radios of feature maps of all  level."""
         _, H, W = mask.shape
@@ -927,21 +1223,43 @@ class DeformableDetrTransformer(Transformer):
         valid_ratio = torch.stack([valid_ratio_w, valid_ratio_h], -1)
         return valid_ratio
 
+    @auto_fp16(apply_to=("output_memory", ), out_fp32=True)
+    def forward_two_stage_branches(
+        self, output_memory, output_proposals, cls_branch, reg_branch
+    ):
+        """Classify and regress the proposals generated from the encoder.
+
+        The branches run on the largest tensor of the two-stage pipeline, so
+        they run in half precision when fp16 is enabled. The outputs are
+        cast back to fp32 for the top-k selection and the sigmoid.
+
+        Args:
+            output_memory (Tensor): The output of
+                :meth:`gen_encoder_output_proposals`, has shape
+                (bs, num_keys, embed_dims).
+            output_proposals (Tensor): The proposals after an inverse
+                sigmoid, has shape (bs, num_keys, 4).
+            cls_branch (nn.Module): The classification branch.
+            reg_branch (nn.Module): The regression branch.
+
+        Returns:
+            tuple[Tensor]: The classification scores and the unnormalized
+                coordinates of the proposals.
+        """
+        enc_outputs_class = cls_branch(output_memory)
+        enc_outputs_coord_unact = reg_branch(output_memory) + output_proposals
+        return enc_outputs_class, enc_outputs_coord_unact
+
     def get_proposal_pos_embed(self, proposals, num_pos_feats=128, temperature=10000):
         """Get the position embedding of proposal."""
         scale = 2 * math.pi
-        dim_t = torch.arange(
-            num_pos_feats, dtype=torch.float32, device=proposals.device
-        )
-        dim_t = temperature ** (2 * (dim_t // 2) / num_pos_feats)
+        dim_t = _proposal_dim_t(num_pos_feats, temperature, proposals.device)
         # N, L, 4
         proposals = proposals.sigmoid() * scale
-        # N, L, 4, 128
+        # N, L, 4, 64
         pos = proposals[:, :, :, None] / dim_t
         # N, L, 4, 64, 2
-        pos = torch.stack(
-            (pos[:, :, :, 0::2].sin(), pos[:, :, :, 1::2].cos()), dim=4
-        ).flatten(2)
+        pos = torch.stack((pos.sin(), pos.cos()), dim=4).flatten(2)
         return pos
 
     def forward(
@@ -1004,44 +1322,33 @@ class DeformableDetrTransformer(Transformer):
         """
         assert self.as_two_stage or query_embed is not None
 
-        feat_flatten = []
-        mask_flatten = []
-        lvl_pos_embed_flatten = []
-        spatial_shapes = []
-        for lvl, (feat, mask, pos_embed) in enumerate(
-            zip(mlvl_feats, mlvl_masks, mlvl_pos_embeds)
-        ):
-            bs, c, h, w = feat.shape
-            spatial_shape = (h, w)
-            spatial_shapes.append(spatial_shape)
-            feat = feat.flatten(2).transpose(1, 2)
-            mask = mask.flatten(1)
-            pos_embed = pos_embed.flatten(2).transpose(1, 2)
-            lvl_pos_embed = pos_embed + self.level_embeds[lvl].view(1, 1, -1)
-            lvl_pos_embed_flatten.append(lvl_pos_embed)
-            feat_flatten.append(feat)
-            mask_flatten.append(mask)
-        feat_flatten = torch.cat(feat_flatten, 1)
-        mask_flatten = torch.cat(mask_flatten, 1)
-        lvl_pos_embed_flatten = torch.cat(lvl_pos_embed_flatten, 1)
-        spatial_shapes = torch.as_tensor(
-            spatial_shapes, dtype=torch.long, device=feat_flatten.device
-        )
-        level_start_index = torch.cat(
-            (spatial_shapes.new_zeros((1,)),
-             spatial_shapes.prod(1).cumsum(0)[:-1])
-        )
-        valid_ratios = torch.stack([self.get_valid_ratio(m)
-                                   for m in mlvl_masks], 1)
+        # the shapes are kept as Python ints for the host side loops, only the
+        # deformable attention needs them as (cached) device tensors
+        mlvl_shapes = tuple(
+            (int(feat.shape[-2]), int(feat.shape[-1])) for feat in mlvl_feats)
+        # concatenate all levels channel first and turn them into the
+        # sequence first layout of the encoder with a single permute,
+        # (bs, embed_dims, H*W) -> (H*W, bs, embed_dims)
+        feat_flatten = torch.cat(
+            [feat.flatten(2) for feat in mlvl_feats], 2).permute(2, 0, 1)
+        mask_flatten = torch.cat([mask.flatten(1) for mask in mlvl_masks], 1)
+        # add the level embeddings of all levels at once, the level index of
+        # each token only depends on the spatial shapes and is cached
+        level_ids = _level_ids(mlvl_shapes, feat_flatten.device)
+        lvl_pos_embed_flatten = torch.cat(
+            [pos_embed.flatten(2) for pos_embed in mlvl_pos_embeds],
+            2).permute(2, 0, 1) + self.level_embeds[level_ids][:, None]
+        # the valid ratios of all levels, counted on the flattened mask at once
+        valid_ratios = self.get_valid_wh(
+            mask_flatten, mlvl_shapes) / _level_wh(
+                mlvl_shapes, mask_flatten.device)
+        spatial_shapes, level_start_index = _spatial_shape_tensors(
+            mlvl_shapes, feat_flatten.device)
 
         reference_points = self.get_reference_points(
-            spatial_shapes, valid_ratios, device=feat.device
+            mlvl_shapes, valid_ratios, device=feat_flatten.device
         )
 
-        feat_flatten = feat_flatten.permute(1, 0, 2)  # (H*W, bs, embed_dims)
-        lvl_pos_embed_flatten = lvl_pos_embed_flatten.permute(
-            1, 0, 2
-        )  # (H*W, bs, embed_dims)
         memory = self.encoder(
             query=feat_flatten,
             key=None,
@@ -1055,18 +1362,20 @@ class DeformableDetrTransformer(Transformer):
             **kwargs,
         )
 
-        memory = memory.permute(1, 0, 2)
-        bs, _, c = memory.shape
+        # memory stays in (H*W, bs, embed_dims) for the decoder, the two-stage
+        # branch works on a batch first view of it
+        _, bs, c = memory.shape
         if self.as_two_stage:
             output_memory, output_proposals = self.gen_encoder_output_proposals(
-                memory, mask_flatten, spatial_shapes
-            )
-            enc_outputs_class = cls_branches[self.decoder.num_layers](
-                output_memory)
-            enc_outputs_coord_unact = (
-                reg_branches[self.decoder.num_layers](
-                    output_memory) + output_proposals
+                memory.transpose(0, 1), mask_flatten, mlvl_shapes
             )
+            enc_outputs_class, enc_outputs_coord_unact = \
+                self.forward_two_stage_branches(
+                    output_memory,
+                    output_proposals,
+                    cls_branches[self.decoder.num_layers],
+                    reg_branches[self.decoder.num_layers],
+                )
 
             topk = self.two_stage_num_proposals
             topk_proposals = torch.topk(
@@ -1091,7 +1400,6 @@ class DeformableDetrTransformer(Transformer):
 
         # decoder
         query = query.permute(1, 0, 2)
-        memory = memory.permute(1, 0, 2)
         query_pos = query_pos.permute(1, 0, 2)
         inter_states, inter_references = self.decoder(
             query=query,
@@ -1184,6 +1492,19 @@ class DynamicConv(BaseModule):
             self.fc_layer = nn.Linear(num_output, self.out_channels)
             self.fc_norm = build_norm_layer(norm_cfg, self.out_channels)[1]
 
+    @staticmethod
+    def _apply_norm(norm, x):
+        """Apply `norm`, calling the LayerNorm kernel directly when possible.
+
+        The output of bmm is already contiguous, so it can be passed to
+        `F.layer_norm` as is, which skips the module call overhead on these
+        small tensors.
+        """
+        if type(norm) is nn.LayerNorm:
+            return F.layer_norm(
+                x, norm.normalized_shape, norm.weight, norm.bias, norm.eps)
+        return norm(x)
+
     def forward(self, param_feature, input_feature):
         """Forward function for `DynamicConv`.
 
@@ -1199,28 +1520,27 @@ class DynamicConv(BaseModule):
             Tensor: The output feature has shape
             (num_all_proposals, out_channels).
         """
-        input_feature = input_feature.flatten(2).permute(2, 0, 1)
-
-        input_feature = input_feature.permute(1, 0, 2)
+        # bmm accepts the transposed view, no copy is needed
+        input_feature = input_feature.flatten(2).transpose(1, 2)
         parameters = self.dynamic_layer(param_feature)
 
-        param_in = parameters[:, : self.num_params_in].view(
-            -1, self.in_channels, self.feat_channels
-        )
-        param_out = parameters[:, -self.num_params_out:].view(
-            -1, self.feat_channels, self.out_channels
-        )
+        # each sample's matrices are dense in `parameters`, so the views can
+        # be consumed by bmm directly without making them contiguous
+        param_in, param_out = parameters.split(
+            [self.num_params_in, self.num_params_out], 1)
+        param_in = param_in.view(-1, self.in_channels, self.feat_channels)
+        param_out = param_out.view(-1, self.feat_channels, self.out_channels)
 
         # input_feature has shape (num_all_proposals, H*W, in_channels)
         # param_in has shape (num_all_proposals, in_channels, feat_channels)
         # feature has shape (num_all_proposals, H*W, feat_channels)
         features = torch.bmm(input_feature, param_in)
-        features = self.norm_in(features)
+        features = self._apply_norm(self.norm_in, features)
         features = self.activation(features)
 
         # param_out has shape (batch_size, feat_channels, out_channels)
         features = torch.bmm(features, param_out)
-        features = self.norm_out(features)
+        features = self._apply_norm(self.norm_out, features)
         features = self.activation(features)
 
         if self.with_proj:
@@ -1232,14 +1552,206 @@ class DynamicConv(BaseModule):
         return features
 
 
+@functools.lru_cache(maxsize=8)
+def _causal_mask(num_seq, device):
+    """The mask of future tokens, `True` for the positions to mask.
+
+    The returned tensor is shared between calls and must not be modified
+    in place.
+    """
+    return torch.ones(
+        (num_seq, num_seq), dtype=torch.bool, device=device).triu(diagonal=1)
+
+
+def _pix2seq_decode_step(
+    decoder, vocal_classifier, input_embed, memory, pos_embed, mask, pre_kv,
+    kv_len, self_attn_mask=None
+):
+    """Decode one step of Pix2seq and classify the output token."""
+    out_dec, pre_kv = decoder(
+        input_embed,
+        memory,
+        pos=pos_embed,
+        memory_key_padding_mask=mask,
+        pre_kv_list=pre_kv,
+        self_attn_mask=self_attn_mask,
+        kv_len=kv_len,
+    )
+    return vocal_classifier(out_dec), pre_kv
+
+
+@functools.lru_cache(maxsize=1)
+def _compiled_pix2seq_decode_step():
+    """Compile :func:`_pix2seq_decode_step` on first use.
+
+    The modules are passed as arguments, so the compiled function keeps no
+    reference to a model and copies of a model decode with their own
+    weights.
+    """
+    return torch.compile(
+        _pix2seq_decode_step, mode="reduce-overhead", dynamic=False)
+
+
 @TRANSFORMER.register_module()
 class Pix2seqTransformer(Transformer):
 
-    def __init__(self, encoder=None, decoder=None, init_cfg=None, pred_eos=False):
+    def __init__(
+        self,
+        encoder=None,
+        decoder=None,
+        init_cfg=None,
+        pred_eos=False,
+        compile_decode_step=False,
+    ):
         super(Pix2seqTransformer, self).__init__(
             encoder=encoder, decoder=decoder, init_cfg=init_cfg
         )
         self.pred_eos = pred_eos
+        # the compiled step is captured with static shapes, the decoding
+        # position is then passed as a tensor and the whole KV cache is
+        # attended with the unused slots masked. The cache is written in
+        # place, so it must have a static address for the step to be
+        # captured in a CUDA graph, otherwise attending the whole cache
+        # would only make decoding slower.
+        self.static_decode_step = False
+        self._static_kv_cache = None
+        if compile_decode_step:
+            if hasattr(torch, "compile") and getattr(
+                    getattr(torch, "_dynamo", None), "mark_static_address",
+                    None) is not None:
+                self.static_decode_step = True
+            else:
+                warnings.warn(
+                    "`compile_decode_step` requires `torch.compile` and "
+                    "`torch._dynamo.mark_static_address`, the decoding step "
+                    "will run eagerly"
+                )
+
+    def _init_kv_cache(self, batch_size, max_len, memory):
+        """Get the key/value cache for decoding.
+
+        With :attr:`static_decode_step`, the cache is kept across calls and
+        marked as a static address, so that the CUDA graph of the compiled
+        step writes into the same memory every time. Its stale slots need
+        no reset since the slots after the decoding position are masked.
+        """
+        if not self.static_decode_step:
+            return self.decoder.init_kv_cache(batch_size, max_len, memory)
+        cache = self._static_kv_cache
+        if (cache is None or cache[0].size(1) != batch_size
+                or cache[0].size(3) != max_len
+                or cache[0].dtype != memory.dtype
+                or cache[0].device != memory.device):
+            cache = self.decoder.init_kv_cache(
+                batch_size, max_len, memory, share_storage=False)
+            for kv in cache:
+                torch._dynamo.mark_static_address(kv)
+            self._static_kv_cache = cache
+        return cache
+
+    def _decode_step(
+        self, input_embed, memory, pos_embed, mask, pre_kv, kv_len,
+        vocal_classifier, self_attn_mask=None
+    ):
+        """Decode one step and classify the output token."""
+        if self.static_decode_step:
+            decode_step = _compiled_pix2seq_decode_step()
+        else:
+            decode_step = _pix2seq_decode_step
+        return decode_step(
+            self.decoder, vocal_classifier, input_embed, memory, pos_embed,
+            mask, pre_kv, kv_len, self_attn_mask)
+
+    def _decode_sequences(
+        self, memory, mask, pos_embed, det_embed, vocal_embed,
+        vocal_classifier, num_vocal, select_tokens, max_steps=500
+    ):
+        """Decode the sequences of a batch step by step.
+
+        Args:
+            memory (Tensor): The output of encoder, has shape
+                (num_keys, bs, embed_dims).
+            mask (Tensor): The padding mask of `memory`, has shape
+                (bs, num_keys).
+            pos_embed (Tensor): The position embedding of `memory`.
+            det_embed (nn.Embedding): The embedding of the prefix.
+            vocal_embed (nn.Module): Embeds the selected tokens.
+            vocal_classifier (nn.Module): Classifies the decoded tokens.
+            num_vocal (int): The size of the vocabulary.
+            select_tokens (callable): Maps the logits of a step, with shape
+                (1, bs, num_logits), to the input of `vocal_embed` for the
+                next step.
+            max_steps (int): The maximum number of decoding steps.
+                Default: 500.
+
+        Returns:
+            list[Tensor]: The logits of each sequence, cut at its end when
+                `pred_eos` is set.
+        """
+        bs = memory.size(1)
+        end = torch.zeros(bs, dtype=torch.bool, device=memory.device)
+        end_lens = torch.zeros(bs, dtype=torch.long, device=memory.device)
+        # a view shared by the batch, the decoder does not need the
+        # queries to be contiguous
+        input_embed = det_embed.weight.unsqueeze(1).expand(-1, bs, -1)
+        # the logits of all steps are written into one buffer, which is
+        # allocated once the vocabulary size is known
+        pred_seq_logits = None
+        num_decoded = 0
+        # the first step decodes the `det_embed` prefix, its keys and
+        # values can not be kept across images since from the second
+        # layer on they depend on `memory` through the cross attention
+        num_prefix = det_embed.num_embeddings
+        max_len = max_steps + num_prefix - 1
+        pre_kv = self._init_kv_cache(bs, max_len, memory)
+        if self.static_decode_step:
+            kv_lens = torch.arange(max_len, device=memory.device)
+        # the prefix attends to itself causally as in training, the tensor
+        # positions of the static step mask the future tokens by themselves
+        prefix_mask = None
+        if num_prefix > 1:
+            prefix_mask = [_causal_mask(num_prefix, memory.device), None]
+        kv_len = 0
+        for seq_i in range(max_steps):
+            if seq_i > 0:
+                # embed the tokens of the previous step, none are embedded
+                # after the last one
+                input_embed = vocal_embed(pred_token)
+            similarity, pre_kv = self._decode_step(
+                input_embed, memory, pos_embed, mask, pre_kv,
+                kv_lens[kv_len] if self.static_decode_step else kv_len,
+                vocal_classifier, prefix_mask if seq_i == 0 else None)
+            kv_len += input_embed.size(0)
+            # only the output of the last token is classified
+            similarity = similarity[-1:]
+
+            if self.pred_eos:
+                is_eos = similarity[:, :, : num_vocal - 1].argmax(dim=-1)
+                stop_state = is_eos.squeeze(0).eq(num_vocal - 2)
+                # record the length of the sequences ending at this step and
+                # update the state in place, all on the device
+                end_lens.add_(seq_i * (stop_state & ~end))
+                end |= stop_state
+                # `end.all()` synchronizes with the device, only check it
+                # every 8 steps, the outputs are cut by `end_lens` anyway
+                if seq_i > 4 and seq_i % 8 == 0 and end.all():
+                    break
+
+            pred_token = select_tokens(similarity)
+            if pred_seq_logits is None:
+                pred_seq_logits = similarity.new_empty(
+                    (bs, max_steps, similarity.size(-1)))
+            pred_seq_logits[:, seq_i] = similarity[0]
+            num_decoded = seq_i + 1
+
+        if not self.pred_eos:
+            end_lens = end_lens.fill_(max_steps)
+        pred_seq_logits = pred_seq_logits[:, :num_decoded]
+        # fetch all the lengths with a single device synchronization
+        return [
+            psl[:end_idx]
+            for end_idx, psl in zip(end_lens.tolist(), pred_seq_logits)
+        ]
 
     def forward(
         self,
@@ -1264,71 +1776,36 @@ class Pix2seqTransformer(Transformer):
             query_pos=pos_embed,  # 已对齐
             key_padding_mask=mask,
         )
-        pre_kv = [
-            torch.as_tensor([[], []], device=memory.device)
-            for _ in range(self.decoder.num_layers)
-        ]
-
         if self.training:
             input_embed = torch.cat(
                 [
-                    det_embed.weight.unsqueeze(0).repeat(bs, 1, 1),
+                    det_embed.weight.unsqueeze(0).expand(bs, -1, -1),
                     vocal_embed(input_seq),
                 ],
                 dim=1,
             )
             input_embed = input_embed.transpose(0, 1)
             num_seq = input_embed.shape[0]
-            self_attn_mask = (
-                torch.triu(torch.ones((num_seq, num_seq)), diagonal=1)
-                .bool()
-                .to(input_embed.device)
-            )
+            self_attn_mask = _causal_mask(num_seq, input_embed.device)
             out_dec, _ = self.decoder(
                 input_embed,  # 没问题
                 memory,
                 memory_key_padding_mask=mask,
                 pos=pos_embed,
-                pre_kv_list=pre_kv,
-                self_attn_mask=self_attn_mask,
+                # the key/value cache is only used when decoding
+                pre_kv_list=[None] * self.decoder.num_layers,
+                # one mask per attention, a bare tensor would be deep
+                # copied for every attention of every layer
+                self_attn_mask=[self_attn_mask, None],
             )
             out_dec = out_dec.transpose(0, 1)
             pred_seq_logits = vocal_classifier(out_dec)
         else:
-            end = torch.zeros(bs).bool().to(memory.device)
-            end_lens = torch.zeros(bs).long().to(memory.device)
-            input_embed = det_embed.weight.unsqueeze(
-                0).repeat(bs, 1, 1).transpose(0, 1)
-            pred_seq_logits = []
-            for seq_i in range(500):
-                out_dec, pre_kv = self.decoder(
-                    input_embed,
-                    memory,
-                    pos=pos_embed,
-                    memory_key_padding_mask=mask,
-                    pre_kv_list=pre_kv,
-                )
-                similarity = vocal_classifier(out_dec)
-
-                if self.pred_eos:
-                    is_eos = similarity[:, :, : num_vocal - 1].argmax(dim=-1)
-                    stop_state = is_eos.squeeze(0).eq(num_vocal - 2)
-                    end_lens += seq_i * (~end * stop_state)
-                    end = (stop_state + end).bool()
-                    if end.all() and seq_i > 4:
-                        break
-
-                pred_token = similarity[:, :,
-                                        : num_vocal - 2].argmax(dim=-1)
-                pred_seq_logits.append(similarity.transpose(0, 1))
-                input_embed = vocal_embed(pred_token)
-
-            if not self.pred_eos:
-                end_lens = end_lens.fill_(500)
-            pred_seq_logits = torch.cat(pred_seq_logits, dim=1)
-            pred_seq_logits = [
-                psl[:end_idx] for end_idx, psl in zip(end_lens, pred_seq_logits)
-            ]
+            pred_seq_logits = self._decode_sequences(
+                memory, mask, pos_embed, det_embed, vocal_embed,
+                vocal_classifier, num_vocal,
+                lambda similarity: similarity[
+                    :, :, : num_vocal - 2].argmax(dim=-1))
 
         return pred_seq_logits
 
@@ -1344,30 +1821,58 @@ class SelfPix2seqAttention(nn.Module):
         self.attn_drop = nn.Dropout(dropout)
         self.proj = nn.Linear(dim, dim)
 
-    def forward(self, x, pre_kv=None, attn_mask=None):
+    def forward(self, x, pre_kv=None, attn_mask=None, kv_len=None):
         N, B, C = x.shape
-        qkv = (
-            self.qkv(x)
-            .reshape(N, B, 3, self.num_heads, C // self.num_heads)
-            .permute(2, 1, 3, 0, 4)
-        )
-        # make torchscript happy (cannot use tensor as tuple)
-        q, k, v = qkv[0], qkv[1], qkv[2]
+        # (N, B, 3 * C) -> 3 x (B, num_heads, N, head_dim), the last dim
+        # stays dense, which is all the attention kernels need
+        q, k, v = (
+            t.permute(1, 2, 0, 3) for t in self.qkv(x).view(
+                N, B, 3, self.num_heads, C // self.num_heads).unbind(2))
 
         if not self.training:
-            k = torch.cat([pre_kv[0], k], dim=2)
-            v = torch.cat([pre_kv[1], v], dim=2)
-            pre_kv = torch.stack([k, v], dim=0)
-
-        attn = (q @ k.transpose(-2, -1)) * self.scale
+            if kv_len is None:
+                k = torch.cat([pre_kv[0], k], dim=2)
+                v = torch.cat([pre_kv[1], v], dim=2)
+                pre_kv = torch.stack([k, v], dim=0)
+            elif isinstance(kv_len, torch.Tensor):
+                # static shape variant for graph capture, write at a tensor
+                # position and attend to the whole cache, masking the slots
+                # after the current tokens
+                pos = kv_len + torch.arange(N, device=k.device)
+                pre_kv[0].index_copy_(2, pos, k)
+                pre_kv[1].index_copy_(2, pos, v)
+                k, v = pre_kv[0], pre_kv[1]
+                attn_mask = torch.arange(
+                    k.size(2), device=k.device)[None] > pos[:, None]
+            else:
+                # `pre_kv` is a preallocated cache holding `kv_len` tokens,
+                # append the new ones in place instead of concatenating
+                pre_kv[0, :, :, kv_len:kv_len + N] = k
+                pre_kv[1, :, :, kv_len:kv_len + N] = v
+                k = pre_kv[0, :, :, :kv_len + N]
+                v = pre_kv[1, :, :, :kv_len + N]
+
+        if hasattr(F, "scaled_dot_product_attention"):
+            # use the fused kernels when available, note the boolean mask of
+            # `scaled_dot_product_attention` marks the positions to attend
+            x = F.scaled_dot_product_attention(
+                q,
+                k,
+                v,
+                attn_mask=None if attn_mask is None else ~attn_mask,
+                dropout_p=self.attn_drop.p if self.training else 0.0,
+            )
+        else:
+            attn = (q @ k.transpose(-2, -1)) * self.scale
 
-        if attn_mask is not None:
-            attn.masked_fill_(attn_mask, float("-inf"))
+            if attn_mask is not None:
+                attn.masked_fill_(attn_mask, float("-inf"))
 
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
+            x = attn @ v
 
-        x = (attn @ v).permute(2, 0, 1, 3).reshape(N, B, C)
+        x = x.permute(2, 0, 1, 3).reshape(N, B, C)
         out = self.proj(x)
         return out, pre_kv
 
@@ -1412,6 +1917,7 @@ class Pix2seqAttention(MultiheadAttention):
         key_pos=None,
         attn_mask=None,
         key_padding_mask=None,
+        kv_len=None,
         **kwargs,
     ):
 
@@ -1441,7 +1947,8 @@ class Pix2seqAttention(MultiheadAttention):
             key = key.transpose(0, 1)
             value = value.transpose(0, 1)
 
-        out, pre_kv = self.attn(x=query, pre_kv=pre_kv, attn_mask=attn_mask)
+        out, pre_kv = self.attn(
+            x=query, pre_kv=pre_kv, attn_mask=attn_mask, kv_len=kv_len)
 
         if self.batch_first:
             out = out.transpose(0, 1)
@@ -1485,6 +1992,7 @@ class Pix2seqTransformerDecoderLayer(DetrTransformerDecoderLayer):
         query_key_padding_mask=None,
         key_padding_mask=None,
         pre_kv=None,
+        kv_len=None,
         **kwargs,
     ):
 
@@ -1522,6 +2030,7 @@ class Pix2seqTransformerDecoderLayer(DetrTransformerDecoderLayer):
                     key_pos=query_pos,
                     attn_mask=attn_masks[attn_index],
                     key_padding_mask=query_key_padding_mask,
+                    kv_len=kv_len,
                     **kwargs,
                 )
                 attn_index += 1
@@ -1570,6 +2079,37 @@ class Pix2seqTransformerDecoder(TransformerLayerSequence):
             )
             self.post_norm = None
 
+    def init_kv_cache(self, batch_size, max_len, memory, share_storage=True):
+        """Allocate the key/value cache of every layer for decoding.
+
+        Args:
+            batch_size (int): The batch size.
+            max_len (int): The maximum number of decoded tokens.
+            memory (Tensor): The output of encoder, the cache is allocated
+                with its dtype and on its device.
+            share_storage (bool): Whether to allocate the caches of all
+                layers as views of a single storage when their shapes are
+                equal. Compiled graphs handle mutated inputs that alias each
+                other poorly, so it is disabled for them. Default: True.
+
+        Returns:
+            list[Tensor]: The cache of each layer, has shape
+                (2, batch_size, num_heads, max_len, head_dim).
+        """
+        shapes = []
+        for layer in self.layers:
+            attn = next(m for m in layer.modules()
+                        if isinstance(m, SelfPix2seqAttention))
+            shapes.append((2, batch_size, attn.num_heads, max_len,
+                           self.embed_dims // attn.num_heads))
+        # zero filled, the unused slots are attended with zero weight when
+        # decoding with static shapes and must not hold NaNs
+        if share_storage and len(set(shapes)) == 1:
+            # a single storage for all layers, each layer gets a view of it
+            return list(memory.new_zeros(
+                (len(shapes), ) + shapes[0]).unbind(0))
+        return [memory.new_zeros(shape) for shape in shapes]
+
     def forward(
         self,
         tgt,
@@ -1578,7 +2118,15 @@ class Pix2seqTransformerDecoder(TransformerLayerSequence):
         pos,
         pre_kv_list=None,
         self_attn_mask=None,
+        kv_len=None,
     ):
+        """Forward function of the decoder.
+
+        When `kv_len` is given, `pre_kv_list` is the cache returned by
+        :meth:`init_kv_cache` with `kv_len` tokens already decoded, the keys
+        and values of `tgt` are written into it in place. If `kv_len` is a
+        0-d tensor, all shapes are independent of the decoding position.
+        """
         output = tgt
         cur_kv_list = []
         for layer, pre_kv in zip(self.layers, pre_kv_list):
@@ -1589,6 +2137,7 @@ class Pix2seqTransformerDecoder(TransformerLayerSequence):
                 key_pos=pos,
                 attn_masks=self_attn_mask,
                 pre_kv=pre_kv,
+                kv_len=kv_len,
             )
             cur_kv_list.append(cur_kv)
 
@@ -1601,9 +2150,11 @@ class Pix2seqTransformerDecoder(TransformerLayerSequence):
 @TRANSFORMER.register_module()
 class Pix2seqTransformerPro(Pix2seqTransformer):
 
-    def __init__(self, encoder=None, decoder=None, init_cfg=None, pred_eos=False, use_gumbels=False):
+    def __init__(self, encoder=None, decoder=None, init_cfg=None, pred_eos=False, use_gumbels=False,
+                 compile_decode_step=False):
         super(Pix2seqTransformerPro, self).__init__(
-            encoder=encoder, decoder=decoder, init_cfg=init_cfg
+            encoder=encoder, decoder=decoder, init_cfg=init_cfg,
+            compile_decode_step=compile_decode_step
         )
         self.pred_eos = pred_eos
 
@@ -1631,72 +2182,35 @@ class Pix2seqTransformerPro(Pix2seqTransformer):
             query_pos=pos_embed,  # 已对齐
             key_padding_mask=mask,
         )
-        pre_kv = [
-            torch.as_tensor([[], []], device=memory.device)
-            for _ in range(self.decoder.num_layers)
-        ]
-        # 这里没问题
 
         if self.training:
             input_embed = torch.cat(
                 [
-                    det_embed.weight.unsqueeze(0).repeat(bs, 1, 1),
+                    det_embed.weight.unsqueeze(0).expand(bs, -1, -1),
                     vocal_embed(input_seq),
                 ],
                 dim=1,
             )
             input_embed = input_embed.transpose(0, 1)
             num_seq = input_embed.shape[0]
-            self_attn_mask = (
-                torch.triu(torch.ones((num_seq, num_seq)), diagonal=1)
-                .bool()
-                .to(input_embed.device)
-            )
+            self_attn_mask = _causal_mask(num_seq, input_embed.device)
             out_dec, _ = self.decoder(
                 input_embed,  # 没问题
                 memory,
                 memory_key_padding_mask=mask,
                 pos=pos_embed,
-                pre_kv_list=pre_kv,
-                self_attn_mask=self_attn_mask,
+                # the key/value cache is only used when decoding
+                pre_kv_list=[None] * self.decoder.num_layers,
+                self_attn_mask=[self_attn_mask, None],
             )
             out_dec = out_dec.transpose(0, 1)
             pred_seq_logits = vocal_classifier(out_dec)
         else:
-            end = torch.zeros(bs).bool().to(memory.device)
-            end_lens = torch.zeros(bs).long().to(memory.device)
-            input_embed = det_embed.weight.unsqueeze(
-                0).repeat(bs, 1, 1).transpose(0, 1)
-            pred_seq_logits = []
-            for seq_i in range(500):
-                out_dec, pre_kv = self.decoder(
-                    input_embed,
-                    memory,
-                    pos=pos_embed,
-                    memory_key_padding_mask=mask,
-                    pre_kv_list=pre_kv,
-                )
-                similarity = vocal_classifier(out_dec)
-
-                if self.pred_eos:
-                    is_eos = similarity[:, :, : num_vocal - 1].argmax(dim=-1)
-                    stop_state = is_eos.squeeze(0).eq(num_vocal - 2)
-                    end_lens += seq_i * (~end * stop_state)
-                    end = (stop_state + end).bool()
-                    if end.all() and seq_i > 4:
-                        break
-
-                pred_token = mutil_hot_gumbel_sigmoid(
-                    similarity, tau=temp, hard=True, use_gumbels=False)
-                pred_seq_logits.append(similarity.transpose(0, 1))
-                input_embed = vocal_embed(pred_token)
-
-            if not self.pred_eos:
-                end_lens = end_lens.fill_(500)
-            pred_seq_logits = torch.cat(pred_seq_logits, dim=1)
-            pred_seq_logits = [
-                psl[:end_idx] for end_idx, psl in zip(end_lens, pred_seq_logits)
-            ]
+            pred_seq_logits = self._decode_sequences(
+                memory, mask, pos_embed, det_embed, vocal_embed,
+                vocal_classifier, num_vocal,
+                lambda similarity: mutil_hot_gumbel_sigmoid(
+                    similarity, tau=temp, hard=True, use_gumbels=False))
 
         return pred_seq_logits
 
@@ -1708,6 +2222,8 @@ def top_k_top_p_filtering(logits, top_k=0, top_p=0.0, filter_value=-float("Inf")
         top_k >0: keep only top k tokens with highest probability (top-k filtering).
         top_p >0.0: keep the top tokens with cumulative probability >= top_p (nucleus filtering).
             Nucleus filtering is described in Holtzman et al. (http://arxiv.org/abs/1904.09751)
+    The logits are filtered in place and returned. Tokens tied with the
+    last token kept by the nucleus are all kept.
     """
     assert (
         logits.dim() == 1
@@ -1717,22 +2233,46 @@ def top_k_top_p_filtering(logits, top_k=0, top_p=0.0, filter_value=-float("Inf")
         # Remove all tokens with a probability less than the last token of the top-k
         indices_to_remove = logits < torch.topk(logits, top_k)[
             0][..., -1, None]
-        logits[indices_to_remove] = filter_value
+        logits.masked_fill_(indices_to_remove, filter_value)
     if top_p > 0.0:
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-        cumulative_probs = torch.cumsum(
-            F.softmax(sorted_logits, dim=-1), dim=-1)
-        # Remove tokens with cumulative probability above the threshold
-        sorted_indices_to_remove = cumulative_probs > top_p
-        # Shift the indices to the right to keep also the first token above the threshold
-        sorted_indices_to_remove[...,
-                                 1:] = sorted_indices_to_remove[..., :-1].clone()
-        sorted_indices_to_remove[..., 0] = 0
-        indices_to_remove = sorted_indices[sorted_indices_to_remove]
-        logits[indices_to_remove] = filter_value
+        probs = F.softmax(logits, dim=-1)
+        sorted_probs = torch.sort(probs, descending=True)[0]
+        # Keep the tokens until the cumulative probability exceeds the
+        # threshold, including the first token above it. Filter by the
+        # probability of the last kept token, so the logits are masked
+        # directly instead of through the sorted indices.
+        num_keep = (sorted_probs.cumsum(-1) <= top_p).sum(-1, keepdim=True)
+        num_keep = num_keep.clamp(max=logits.size(-1) - 1)
+        min_prob = sorted_probs.gather(-1, num_keep)
+        logits.masked_fill_(probs < min_prob, filter_value)
     return logits
 
 
+def sample_top_p(logits, top_p):
+    """Sample a token from the nucleus (top-p) of a distribution of logits.
+
+    The fused sampling kernel of `flashinfer>=0.2` is used when it is
+    installed and `logits` is on a CUDA device, otherwise the logits are
+    filtered with :func:`top_k_top_p_filtering` and sampled with
+    `torch.multinomial`.
+
+    Args:
+        logits (Tensor): logits distribution shape (vocabulary size).
+        top_p (float): keep the top tokens with cumulative probability
+            >= top_p.
+
+    Returns:
+        Tensor: The sampled token index, has shape (1, ).
+    """
+    if top_p_sampling_from_probs is not None and logits.is_cuda:
+        probabilities = F.softmax(logits.float(), dim=-1)
+        return top_p_sampling_from_probs(
+            probabilities[None], top_p=top_p).long()
+    filtered_logits = top_k_top_p_filtering(logits, top_p=top_p)
+    probabilities = F.softmax(filtered_logits, dim=-1)
+    return torch.multinomial(probabilities, 1)
+
+
 @TRANSFORMER_LAYER_SEQUENCE.register_module()
 class VQVAETransformerDecoder(TransformerLayerSequence):
     """TransformerEncoder of DETR.
@@ -1792,6 +2332,16 @@ class VQVAETransformerDecoder(TransformerLayerSequence):
             return query
 
 
+@functools.lru_cache(maxsize=8)
+def _non_diagonal_mask(num_seq, device):
+    """The mask letting each token attend only to itself.
+
+    The returned tensor is shared between calls and must not be modified
+    in place.
+    """
+    return ~torch.eye(num_seq, dtype=torch.bool, device=device)
+
+
 @TRANSFORMER.register_module()
 class VQVAETransformer(BaseModule):
     def __init__(
@@ -1819,16 +2369,15 @@ class VQVAETransformer(BaseModule):
         # x需要[h*w, bs, c]
         x = x.permute(1, 0, 2)
         num_seque = x.shape[0]
-        attn_masks = torch.logical_not(
-            torch.eye(num_seque, device=x.device)
-        )
+        attn_masks = _non_diagonal_mask(
+            num_seque, x.device) if self.attn_mask else None
         memory = self.encoder(
             query=x,  # [100, 32, 256]
             key=None,
             value=None,
             query_pos=None,
             query_key_padding_mask=mask,  # [32, 100]
-            attn_masks=attn_masks if self.attn_mask else None
+            attn_masks=attn_masks
         )
         # out_dec: [num_layers, num_query, bs, dim]
         memory, diff, ids = self.quantize(memory)
@@ -1839,7 +2388,7 @@ class VQVAETransformer(BaseModule):
             query_pos=None,
             query_key_padding_mask=mask,
             return_inter=self.return_inter,
-            attn_masks=attn_masks if self.attn_mask else None
+            attn_masks=attn_masks
         )  # -5.6495
         if self.return_inter:
             # [num_layers, num_query, bs, dim]
@@ -1858,16 +2407,15 @@ class VQVAETransformer(BaseModule):
             'b n, n d -> b d', y_hard, self.quantize._embedding1.weight)
         quantized = self.quantize.fc_out(quantized).unsqueeze(1)
         num_seque = _soft_one_hot.shape[0]
-        attn_masks = torch.logical_not(
-            torch.eye(num_seque, device=quantized.device)
-        )
+        attn_masks = _non_diagonal_mask(
+            num_seque, quantized.device) if self.attn_mask else None
         out_dec = self.decoder(
             query=quantized,
             key=None,
             value=None,
             query_pos=None,
             return_inter=False,
-            attn_masks=attn_masks if self.attn_mask else None
+            attn_masks=attn_masks
         )
         out_dec = out_dec.unsqueeze(0).transpose(
             1, 2)
@@ -1891,13 +2439,12 @@ class CustomSigmoidQuantizer(nn.Module):
         input_shape = inputs.shape
         # Flatten input
         flat_input = inputs.view(-1, self._embedding_dim)
-        log_uniform = torch.log(torch.tensor(
-            [1. / self._num_embeddings], device=inputs.device))
+        log_uniform = flat_input.new_full(
+            (1, ), -math.log(self._num_embeddings))
         _logits = self.fc(flat_input)
         _soft_one_hot = mutil_hot_gumbel_sigmoid(
             _logits, tau=temp, hard=True, use_gumbels=False)
-        quantized = torch.einsum(
-            'b n, n d -> b d', _soft_one_hot, self._embedding1.weight).view(input_shape)
+        quantized = (_soft_one_hot @ self._embedding1.weight).view(input_shape)
         N, B, _ = input_shape
         encoding_indices = _soft_one_hot.view((N, B, self._num_embeddings))
         _log_qy = F.log_softmax(_logits, dim=-1)
@@ -1933,13 +2480,13 @@ def mutil_hot_gumbel_sigmoid(logits, tau=1, hard=False, eps=1e-10, use_gumbels=T
 
 
 @TRANSFORMER.register_module()
-class Pix2seqTransformerCode(Transformer):
+class Pix2seqTransformerCode(Pix2seqTransformer):
 
     def __init__(self, encoder=None, decoder=None, init_cfg=None, pred_eos=False):
         super(Pix2seqTransformerCode, self).__init__(
-            encoder=encoder, decoder=decoder, init_cfg=init_cfg
+            encoder=encoder, decoder=decoder, init_cfg=init_cfg,
+            pred_eos=pred_eos
         )
-        self.pred_eos = pred_eos
 
     def forward(
         self,
@@ -1964,73 +2511,42 @@ class Pix2seqTransformerCode(Transformer):
             query_pos=pos_embed,  # 已对齐
             key_padding_mask=mask,
         )
-        pre_kv = [
-            torch.as_tensor([[], []], device=memory.device)
-            for _ in range(self.decoder.num_layers)
-        ]
-
         if self.training:
             input_embed = torch.cat(
                 [
-                    det_embed.weight.unsqueeze(0).repeat(bs, 1, 1),
+                    det_embed.weight.unsqueeze(0).expand(bs, -1, -1),
                     vocal_embed(input_seq),
                 ],
                 dim=1,
             )
             input_embed = input_embed.transpose(0, 1)
             num_seq = input_embed.shape[0]
-            self_attn_mask = (
-                torch.triu(torch.ones((num_seq, num_seq)), diagonal=1)
-                .bool()
-                .to(input_embed.device)
-            )
+            self_attn_mask = _causal_mask(num_seq, input_embed.device)
             out_dec, _ = self.decoder(
                 input_embed,  # 没问题
                 memory,
                 memory_key_padding_mask=mask,
                 pos=pos_embed,
-                pre_kv_list=pre_kv,
-                self_attn_mask=self_attn_mask,
+                # the key/value cache is only used when decoding
+                pre_kv_list=[None] * self.decoder.num_layers,
+                self_attn_mask=[self_attn_mask, None],
             )
             out_dec = out_dec.transpose(0, 1)
             pred_seq_logits = vocal_classifier(out_dec)
         else:
-            end = torch.zeros(bs).bool().to(memory.device)
-            end_lens = torch.zeros(bs).long().to(memory.device)
-            input_embed = det_embed.weight.unsqueeze(
-                0).repeat(bs, 1, 1).transpose(0, 1)
-            pred_seq_logits = []
-            for seq_i in range(100):
-                out_dec, pre_kv = self.decoder(
-                    input_embed,
-                    memory,
-                    pos=pos_embed,
-                    memory_key_padding_mask=mask,
-                    pre_kv_list=pre_kv,
-                )
-                similarity = vocal_classifier(out_dec)
-
-                if self.pred_eos:
-                    is_eos = similarity[:, :, : num_vocal - 1].argmax(dim=-1)
-                    stop_state = is_eos.squeeze(0).eq(num_vocal - 2)
-                    end_lens += seq_i * (~end * stop_state)
-                    end = (stop_state + end).bool()
-                    if end.all() and seq_i > 4:
-                        break
-                pred_seq_logits.append(similarity.transpose(0, 1))
-                pred_tokens = []
-                for i in range(5):
-                    pred_token = F.one_hot(
-                        similarity[..., i*num_vocal:(i+1)*num_vocal].argmax(-1), num_classes=num_vocal)
-                    pred_tokens.append(pred_token)
-                pred_tokens = torch.cat(pred_tokens, dim=-1).to(similarity.device)
-                input_embed = vocal_embed(pred_tokens.float())
-
-            if not self.pred_eos:
-                end_lens = end_lens.fill_(500)
-            pred_seq_logits = torch.cat(pred_seq_logits, dim=1)
-            pred_seq_logits = [
-                psl[:end_idx] for end_idx, psl in zip(end_lens, pred_seq_logits)
-            ]
+
+            def select_tokens(similarity):
+                # one-hot of the argmax of each of the 5 coordinates
+                pred_tokens = [
+                    F.one_hot(
+                        similarity[..., i * num_vocal:(i + 1) * num_vocal]
+                        .argmax(-1), num_classes=num_vocal)
+                    for i in range(5)
+                ]
+                return torch.cat(pred_tokens, dim=-1).float()
+
+            pred_seq_logits = self._decode_sequences(
+                memory, mask, pos_embed, det_embed, vocal_embed,
+                vocal_classifier, num_vocal, select_tokens, max_steps=100)
 
         return pred_seq_logits
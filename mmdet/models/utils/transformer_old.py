@@ -32,6 +32,7 @@ from mmcv.utils import to_2tuple
 from torch.nn.init import normal_
 from mmcv import ConfigDict
 from mmdet.models.utils.builder import TRANSFORMER
+from mmdet.models.utils.transformer import sample_top_p
 
 try:
     from mmcv.ops.multi_scale_deform_attn import MultiScaleDeformableAttention
@@ -1314,7 +1315,7 @@ class Pix2seqTransformer(Transformer):
         if self.training:
             input_embed = torch.cat(
                 [
-                    det_embed.weight.unsqueeze(0).repeat(bs, 1, 1),
+                    det_embed.weight.unsqueeze(0).expand(bs, -1, -1),
                     vocal_embed(input_seq),
                 ],
                 dim=1,
@@ -1337,12 +1338,16 @@ class Pix2seqTransformer(Transformer):
             out_dec = out_dec.transpose(0, 1)
             pred_seq_logits = vocal_classifier(out_dec)
         else:
-            end = torch.zeros(bs).bool().to(memory.device)
-            end_lens = torch.zeros(bs).long().to(memory.device)
-            input_embed = det_embed.weight.unsqueeze(
-                0).repeat(bs, 1, 1).transpose(0, 1)
-            pred_seq_logits = []
+            end = torch.zeros(bs, dtype=torch.bool, device=memory.device)
+            end_lens = torch.zeros(bs, dtype=torch.long, device=memory.device)
+            input_embed = det_embed.weight.unsqueeze(1).expand(-1, bs, -1)
+            # the logits of all steps are written into one buffer, which is
+            # allocated once the vocabulary size is known
+            pred_seq_logits = None
+            num_decoded = 0
             for seq_i in range(500):
+                if seq_i > 0:
+                    input_embed = vocal_embed(pred_token)
                 out_dec, pre_kv = self.decoder(
                     input_embed,
                     memory,
@@ -1355,34 +1360,37 @@ class Pix2seqTransformer(Transformer):
                 if self.pred_eos:
                     is_eos = similarity[:, :, : num_vocal - 1].argmax(dim=-1)
                     stop_state = is_eos.squeeze(0).eq(num_vocal - 2)
-                    end_lens += seq_i * (~end * stop_state)
-                    end = (stop_state + end).bool()
-                    if end.all() and seq_i > 4:
+                    end_lens.add_(seq_i * (stop_state & ~end))
+                    end |= stop_state
+                    # `end.all()` synchronizes with the device, only check it
+                    # every 8 steps, the outputs are cut by `end_lens` anyway
+                    if seq_i > 4 and seq_i % 8 == 0 and end.all():
                         break
 
+                if pred_seq_logits is None:
+                    pred_seq_logits = similarity.new_empty(
+                        (bs, 500, similarity.size(-1)))
                 if nucleus_sampling:
-                    filtered_logits = top_k_top_p_filtering(
-                        torch.squeeze(similarity), top_p=self.top_p
-                    )
-                    probabilities = F.softmax(filtered_logits, dim=-1)
-                    pred_token = torch.multinomial(probabilities, 1).clamp(
+                    pred_token = sample_top_p(
+                        torch.squeeze(similarity), self.top_p).clamp(
                         max=self.num_bins + self.num_classes
                     )
-                    pred_similarity = torch.zeros_like(similarity)
-                    pred_similarity[:, :, pred_token] = 1.0
                     pred_token = pred_token.view(1, -1)
-                    pred_seq_logits.append(pred_similarity.transpose(0, 1))
+                    # one-hot of the sampled tokens, scattered into the buffer
+                    pred_seq_logits[:, seq_i].zero_().scatter_(
+                        -1, pred_token.transpose(0, 1), 1.0)
                 else:
                     pred_token = similarity[:, :,
                                             : num_vocal - 2].argmax(dim=-1)
-                    pred_seq_logits.append(similarity.transpose(0, 1))
-                input_embed = vocal_embed(pred_token)
+                    pred_seq_logits[:, seq_i] = similarity[0]
+                num_decoded = seq_i + 1
 
             if not self.pred_eos:
                 end_lens = end_lens.fill_(500)
-            pred_seq_logits = torch.cat(pred_seq_logits, dim=1)
+            pred_seq_logits = pred_seq_logits[:, :num_decoded]
             pred_seq_logits = [
-                psl[:end_idx] for end_idx, psl in zip(end_lens, pred_seq_logits)
+                psl[:end_idx]
+                for end_idx, psl in zip(end_lens.tolist(), pred_seq_logits)
             ]
 
         return pred_seq_logits
@@ -1692,7 +1700,7 @@ class Pix2seqTransformerPro(Pix2seqTransformer):
         if self.training:
             input_embed = torch.cat(
                 [
-                    det_embed.weight.unsqueeze(0).repeat(bs, 1, 1),
+                    det_embed.weight.unsqueeze(0).expand(bs, -1, -1),
                     vocal_embed(input_seq),
                 ],
                 dim=1,
@@ -1715,12 +1723,14 @@ class Pix2seqTransformerPro(Pix2seqTransformer):
             out_dec = out_dec.transpose(0, 1)
             pred_seq_logits = vocal_classifier(out_dec)
         else:
-            end = torch.zeros(bs).bool().to(memory.device)
-            end_lens = torch.zeros(bs).long().to(memory.device)
-            input_embed = det_embed.weight.unsqueeze(
-                0).repeat(bs, 1, 1).transpose(0, 1)
-            pred_seq_logits = []
+            end = torch.zeros(bs, dtype=torch.bool, device=memory.device)
+            end_lens = torch.zeros(bs, dtype=torch.long, device=memory.device)
+            input_embed = det_embed.weight.unsqueeze(1).expand(-1, bs, -1)
+            pred_seq_logits = None
+            num_decoded = 0
             for seq_i in range(500):
+                if seq_i > 0:
+                    input_embed = vocal_embed(pred_token)
                 out_dec, pre_kv = self.decoder(
                     input_embed,
                     memory,
@@ -1733,34 +1743,35 @@ class Pix2seqTransformerPro(Pix2seqTransformer):
                 if self.pred_eos:
                     is_eos = similarity[:, :, : num_vocal - 1].argmax(dim=-1)
                     stop_state = is_eos.squeeze(0).eq(num_vocal - 2)
-                    end_lens += seq_i * (~end * stop_state)
-                    end = (stop_state + end).bool()
-                    if end.all() and seq_i > 4:
+                    end_lens.add_(seq_i * (stop_state & ~end))
+                    end |= stop_state
+                    if seq_i > 4 and seq_i % 8 == 0 and end.all():
                         break
 
+                if pred_seq_logits is None:
+                    pred_seq_logits = similarity.new_empty(
+                        (bs, 500, similarity.size(-1)))
                 if nucleus_sampling:
-                    filtered_logits = top_k_top_p_filtering(
-                        torch.squeeze(similarity), top_p=self.top_p
-                    )
-                    probabilities = F.softmax(filtered_logits, dim=-1)
-                    pred_token = torch.multinomial(probabilities, 1).clamp(
+                    pred_token = sample_top_p(
+                        torch.squeeze(similarity), self.top_p).clamp(
                         max=self.num_bins + self.num_classes
                     )
-                    pred_similarity = torch.zeros_like(similarity)
-                    pred_similarity[:, :, pred_token] = 1.0
                     pred_token = pred_token.view(1, -1)
-                    pred_seq_logits.append(pred_similarity.transpose(0, 1))
+                    # one-hot of the sampled tokens, scattered into the buffer
+                    pred_seq_logits[:, seq_i].zero_().scatter_(
+                        -1, pred_token.transpose(0, 1), 1.0)
                 else:
                     pred_token = similarity[:, :,
                                             : num_vocal - 2].argmax(dim=-1)
-                    pred_seq_logits.append(similarity.transpose(0, 1))
-                input_embed = vocal_embed(pred_token)
+                    pred_seq_logits[:, seq_i] = similarity[0]
+                num_decoded = seq_i + 1
 
             if not self.pred_eos:
                 end_lens = end_lens.fill_(500)
-            pred_seq_logits = torch.cat(pred_seq_logits, dim=1)
+            pred_seq_logits = pred_seq_logits[:, :num_decoded]
             pred_seq_logits = [
-                psl[:end_idx] for end_idx, psl in zip(end_lens, pred_seq_logits)
+                psl[:end_idx]
+                for end_idx, psl in zip(end_lens.tolist(), pred_seq_logits)
             ]
 
         return pred_seq_logits
@@ -1773,6 +1784,8 @@ def top_k_top_p_filtering(logits, top_k=0, top_p=0.0, filter_value=-float("Inf")
         top_k >0: keep only top k tokens with highest probability (top-k filtering).
         top_p >0.0: keep the top tokens with cumulative probability >= top_p (nucleus filtering).
             Nucleus filtering is described in Holtzman et al. (http://arxiv.org/abs/1904.09751)
+    The logits are filtered in place and returned. Tokens tied with the
+    last token kept by the nucleus are all kept.
     """
     assert (
         logits.dim() == 1
@@ -1782,19 +1795,18 @@ def top_k_top_p_filtering(logits, top_k=0, top_p=0.0, filter_value=-float("Inf")
         # Remove all tokens with a probability less than the last token of the top-k
         indices_to_remove = logits < torch.topk(logits, top_k)[
             0][..., -1, None]
-        logits[indices_to_remove] = filter_value
+        logits.masked_fill_(indices_to_remove, filter_value)
     if top_p > 0.0:
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-        cumulative_probs = torch.cumsum(
-            F.softmax(sorted_logits, dim=-1), dim=-1)
-        # Remove tokens with cumulative probability above the threshold
-        sorted_indices_to_remove = cumulative_probs > top_p
-        # Shift the indices to the right to keep also the first token above the threshold
-        sorted_indices_to_remove[...,
-                                 1:] = sorted_indices_to_remove[..., :-1].clone()
-        sorted_indices_to_remove[..., 0] = 0
-        indices_to_remove = sorted_indices[sorted_indices_to_remove]
-        logits[indices_to_remove] = filter_value
+        probs = F.softmax(logits, dim=-1)
+        sorted_probs = torch.sort(probs, descending=True)[0]
+        # Keep the tokens until the cumulative probability exceeds the
+        # threshold, including the first token above it. Filter by the
+        # probability of the last kept token, so the logits are masked
+        # directly instead of through the sorted indices.
+        num_keep = (sorted_probs.cumsum(-1) <= top_p).sum(-1, keepdim=True)
+        num_keep = num_keep.clamp(max=logits.size(-1) - 1)
+        min_prob = sorted_probs.gather(-1, num_keep)
+        logits.masked_fill_(probs < min_prob, filter_value)
     return logits
 
 
@@ -1942,6 +1954,24 @@ class VectorQuantizer(nn.Module):
             self._num_embeddings, self._embedding_dim)
         self._embedding.weight.data.uniform_(-1, 1)
         self._commitment_cost = commitment_cost
+        # ||e||^2 of the codebook, reused while the weight is unchanged
+        self._weight_sq = None
+        self._weight_sq_key = None
+
+    def _codebook_sq_norm(self):
+        """Get the squared norms of the codebook embeddings.
+
+        The result is reused as long as the weight is neither updated in
+        place nor replaced, which is the case for every call at inference.
+        It only feeds the argmin over the distances, so no gradient is kept.
+        """
+        weight = self._embedding.weight
+        key = (weight.data_ptr(), weight._version, weight.dtype)
+        if self._weight_sq_key != key:
+            with torch.no_grad():
+                self._weight_sq = torch.sum(weight ** 2, dim=1)
+            self._weight_sq_key = key
+        return self._weight_sq
 
     def forward(self, inputs):
         # convert inputs from BCHW -> BHWC
@@ -1950,23 +1980,23 @@ class VectorQuantizer(nn.Module):
         # Flatten input
         flat_input = inputs.view(-1, self._embedding_dim)
 
-        # Calculate distances
-        distances = (
-            torch.sum(flat_input ** 2, dim=1, keepdim=True)
-            + torch.sum(self._embedding.weight ** 2, dim=1)
-            - 2 * torch.matmul(flat_input, self._embedding.weight.t())
+        # Calculate distances, ||x||^2 is the same for all the embeddings of
+        # a row and does not change the argmin, so only ||e||^2 - 2 x.e is
+        # computed, in a single addmm
+        distances = torch.addmm(
+            self._codebook_sq_norm(),
+            flat_input,
+            self._embedding.weight.t(),
+            alpha=-2,
         )
 
         # Encoding
         encoding_indices = torch.argmin(distances, dim=1).unsqueeze(1)
-        encodings = torch.zeros(
-            encoding_indices.shape[0], self._num_embeddings, device=inputs.device
-        )
-        encodings.scatter_(1, encoding_indices, 1)
 
-        # Quantize and unflatten
-        quantized = torch.matmul(
-            encodings, self._embedding.weight).view(input_shape)
+        # Quantize and unflatten, looking the embeddings up is the same as
+        # multiplying their one-hot encodings with the codebook
+        quantized = self._embedding(encoding_indices.squeeze(1)).view(
+            input_shape)
 
         # Loss
         e_latent_loss = F.mse_loss(quantized.detach(), inputs)
@@ -1979,6 +2009,25 @@ class VectorQuantizer(nn.Module):
         return quantized, loss, encoding_indices
 
 
+def gumbel_quantize(soft_one_hot, weight, hard):
+    """Mix the codebook with the gumbel softmax samples.
+
+    Args:
+        soft_one_hot (Tensor): The samples, has shape (N, num_embeddings).
+        weight (Tensor): The codebook, has shape
+            (num_embeddings, embedding_dim).
+        hard (bool): Whether the samples are one-hot.
+
+    Returns:
+        Tensor: The quantized vectors, has shape (N, embedding_dim).
+    """
+    if hard and not torch.is_grad_enabled():
+        # without the straight-through gradient, multiplying one-hots with
+        # the codebook is just a lookup
+        return F.embedding(soft_one_hot.argmax(dim=1), weight)
+    return soft_one_hot @ weight
+
+
 class GumbelQuantizer(nn.Module):
     def __init__(self, num_embeddings, embedding_dim, straight_through=False):
         super(GumbelQuantizer, self).__init__()
@@ -1999,13 +2048,14 @@ class GumbelQuantizer(nn.Module):
         logits = self.fc(flat_input)  # [6400, 512] -> [6400, 8192]
         soft_one_hot = F.gumbel_softmax(
             logits, tau=temp, dim=1, hard=self.straight_through)  # [6400, 8192]
-        quantized = torch.einsum(
-            'b n, n d -> b d', soft_one_hot, self._embedding.weight).view(input_shape) # [6400, 512]
+        quantized = gumbel_quantize(
+            soft_one_hot, self._embedding.weight,
+            self.straight_through).view(input_shape) # [6400, 512]
         # encoding_indices = logits.argmax(dim=1)
         encoding_indices = soft_one_hot.argmax(dim=1)
         log_qy = F.log_softmax(logits, dim=-1)
-        log_uniform = torch.log(torch.tensor(
-            [1. / self._num_embeddings], device=inputs.device))
+        log_uniform = flat_input.new_full(
+            (1, ), -math.log(self._num_embeddings))
         loss = F.kl_div(log_uniform, log_qy, None, None,
                           'batchmean', log_target=True)
         return quantized, loss*kl_div_loss_weight, encoding_indices
@@ -2038,17 +2088,19 @@ class DoubleGumbelQuantizer(nn.Module):
             logits1, tau=temp, dim=1, hard=self.straight_through)  # [6400, 8192]
         soft_one_hot2 = F.gumbel_softmax(
             logits2, tau=temp, dim=1, hard=self.straight_through)
-        quantized1 = torch.einsum(
-            'b n, n d -> b d', soft_one_hot1, self._embedding1.weight).view(input_shape) # [6400, 512]
-        quantized2 = torch.einsum(
-            'b n, n d -> b d', soft_one_hot2, self._embedding2.weight).view(input_shape)
+        quantized1 = gumbel_quantize(
+            soft_one_hot1, self._embedding1.weight,
+            self.straight_through).view(input_shape) # [6400, 512]
+        quantized2 = gumbel_quantize(
+            soft_one_hot2, self._embedding2.weight,
+            self.straight_through).view(input_shape)
         # encoding_indices = logits.argmax(dim=1)
         encoding_indices1 = soft_one_hot1.argmax(dim=1)
         encoding_indices2 = soft_one_hot2.argmax(dim=1)
         log_qy1 = F.log_softmax(logits1, dim=-1)
         log_qy2 = F.log_softmax(logits2, dim=-1)
-        log_uniform = torch.log(torch.tensor(
-            [1. / self._num_embeddings], device=inputs.device))
+        log_uniform = flat_input.new_full(
+            (1, ), -math.log(self._num_embeddings))
         loss1 = F.kl_div(log_uniform, log_qy1, None, None,
                           'batchmean', log_target=True)
         loss2 = F.kl_div(log_uniform, log_qy2, None, None,
@@ -2077,8 +2129,8 @@ class CustomGumbelQuantizer(nn.Module):
         input_shape = inputs.shape
         # Flatten input
         flat_input = inputs.view(-1, self._embedding_dim)
-        log_uniform = torch.log(torch.tensor(
-            [1. / self._num_embeddings], device=inputs.device))
+        log_uniform = flat_input.new_full(
+            (1, ), -math.log(self._num_embeddings))
         encoding_indices = []
         quantized = []
         loss = []
@@ -2086,8 +2138,9 @@ class CustomGumbelQuantizer(nn.Module):
             _logits = fc(flat_input)
             _soft_one_hot = F.gumbel_softmax(
                 _logits, tau=temp, dim=1, hard=self.straight_through)
-            _quantized = torch.einsum(
-                'b n, n d -> b d', _soft_one_hot, self._embedding1.weight).view(input_shape)
+            _quantized = gumbel_quantize(
+                _soft_one_hot, self._embedding1.weight,
+                self.straight_through).view(input_shape)
             _encoding_indices = _soft_one_hot.argmax(dim=1)
             _log_qy = F.log_softmax(_logits, dim=-1)
             _loss = F.kl_div(log_uniform, _log_qy, None, None,
@@ -1,12 +1,24 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+import sys
+import types
+
 import pytest
 import torch
+import torch.nn as nn
+import torch.nn.functional as F
 from mmcv.utils import ConfigDict
 
 from mmdet.models.utils.transformer import (AdaptivePadding,
+                                            DeformableDetrTransformer,
                                             DetrTransformerDecoder,
                                             DetrTransformerEncoder, PatchEmbed,
-                                            PatchMerging, Transformer)
+                                            PatchMerging,
+                                            Pix2seqTransformer,
+                                            Pix2seqTransformerDecoder,
+                                            Transformer,
+                                            _import_top_p_sampling,
+                                            sample_top_p,
+                                            top_k_top_p_filtering)
 
 
 def test_adaptive_padding():
@@ -314,6 +326,25 @@ def test_patch_embed():
         assert out_size == (1, 3)
         assert x_out.size(1) == out_size[0] * out_size[1]
 
+    # test the "same" padding folded into the conv is consistent with
+    # padding the input explicitly
+    patch_embed = PatchEmbed(
+        in_channels=3, embed_dims=10, kernel_size=3, stride=1, padding='same')
+    assert patch_embed.fuse_padding
+    x = torch.rand(2, 3, 7, 8)
+    x_out, out_size = patch_embed(x)
+    assert out_size == (7, 8)
+    x_ref = patch_embed.projection(patch_embed.adap_padding(x))
+    assert torch.allclose(x_out, x_ref.flatten(2).transpose(1, 2), atol=1e-6)
+
+    # the hooks of the projection still run
+    hook_inputs = []
+    patch_embed.projection.register_forward_pre_hook(
+        lambda module, inputs: hook_inputs.append(inputs[0].shape))
+    x_out_hooked, _ = patch_embed(x)
+    assert hook_inputs == [(2, 3, 9, 10)]
+    assert torch.allclose(x_out_hooked, x_out)
+
 
 def test_patch_merging():
 
@@ -464,6 +495,18 @@ def test_patch_merging():
         assert out_size == (1, 3)
         assert x_out.size(1) == out_size[0] * out_size[1]
 
+    # test merging non-overlapping windows by reshape is consistent
+    # with `nn.Unfold`
+    patch_merge = PatchMerging(
+        in_channels=3, out_channels=4, kernel_size=2, padding=0)
+    x = torch.rand(2, 4 * 6, 3)
+    x_out, out_size = patch_merge(x, (4, 6))
+    assert x_out.size() == (2, 6, 4)
+    assert out_size == (2, 3)
+    x_ref = patch_merge.sampler(x.view(2, 4, 6, 3).permute(0, 3, 1, 2))
+    x_ref = patch_merge.reduction(patch_merge.norm(x_ref.transpose(1, 2)))
+    assert torch.allclose(x_out, x_ref, atol=1e-6)
+
 
 def test_detr_transformer_dencoder_encoder_layer():
     config = ConfigDict(
@@ -567,3 +610,458 @@ def test_transformer():
             )))
     transformer = Transformer(**config)
     transformer.init_weights()
+
+
+def _padded_mlvl_masks(spatial_shapes, valid_hw):
+    """Padding masks of all levels for a batch of images of different sizes,
+    built the way the DETR heads do."""
+    img_h, img_w = 4 * spatial_shapes[0][0], 4 * spatial_shapes[0][1]
+    img_masks = torch.ones(len(valid_hw), img_h, img_w)
+    for img_id, (h, w) in enumerate(valid_hw):
+        img_masks[img_id, :h, :w] = 0
+    return [
+        F.interpolate(img_masks[None], size=shape).to(torch.bool)[0]
+        for shape in spatial_shapes
+    ]
+
+
+def _ref_reference_points(spatial_shapes, valid_ratios):
+    """The per level implementation of `get_reference_points`."""
+    reference_points_list = []
+    for lvl, (H, W) in enumerate(spatial_shapes):
+        ref_y, ref_x = torch.meshgrid(
+            torch.linspace(0.5, H - 0.5, H, dtype=torch.float32),
+            torch.linspace(0.5, W - 0.5, W, dtype=torch.float32))
+        ref_y = ref_y.reshape(-1)[None] / (valid_ratios[:, None, lvl, 1] * H)
+        ref_x = ref_x.reshape(-1)[None] / (valid_ratios[:, None, lvl, 0] * W)
+        reference_points_list.append(torch.stack((ref_x, ref_y), -1))
+    reference_points = torch.cat(reference_points_list, 1)
+    return reference_points[:, :, None] * valid_ratios[:, None]
+
+
+def _ref_encoder_output_proposals(memory, memory_padding_mask,
+                                  spatial_shapes):
+    """The per level implementation of `gen_encoder_output_proposals`,
+    without the output projection."""
+    N = memory.size(0)
+    proposals = []
+    _cur = 0
+    for lvl, (H, W) in enumerate(spatial_shapes):
+        mask_flatten_ = memory_padding_mask[:, _cur:(_cur + H * W)].view(
+            N, H, W, 1)
+        valid_H = torch.sum(~mask_flatten_[:, :, 0, 0], 1)
+        valid_W = torch.sum(~mask_flatten_[:, 0, :, 0], 1)
+        grid_y, grid_x = torch.meshgrid(
+            torch.linspace(0, H - 1, H, dtype=torch.float32),
+            torch.linspace(0, W - 1, W, dtype=torch.float32))
+        grid = torch.cat([grid_x.unsqueeze(-1), grid_y.unsqueeze(-1)], -1)
+        scale = torch.cat([valid_W.unsqueeze(-1),
+                           valid_H.unsqueeze(-1)], 1).view(N, 1, 1, 2)
+        grid = (grid.unsqueeze(0).expand(N, -1, -1, -1) + 0.5) / scale
+        wh = torch.ones_like(grid) * 0.05 * (2.0**lvl)
+        proposals.append(torch.cat((grid, wh), -1).view(N, -1, 4))
+        _cur += H * W
+    output_proposals = torch.cat(proposals, 1)
+    output_proposals_valid = ((output_proposals > 0.01) &
+                              (output_proposals < 0.99)).all(
+                                  -1, keepdim=True)
+    output_proposals = torch.log(output_proposals / (1 - output_proposals))
+    output_proposals = output_proposals.masked_fill(
+        memory_padding_mask.unsqueeze(-1), float('inf'))
+    output_proposals = output_proposals.masked_fill(~output_proposals_valid,
+                                                    float('inf'))
+    output_memory = memory.masked_fill(memory_padding_mask.unsqueeze(-1), 0.)
+    output_memory = output_memory.masked_fill(~output_proposals_valid, 0.)
+    return output_memory, output_proposals
+
+
+def test_deformable_detr_transformer_multi_level_helpers():
+    # only the helpers are tested, so plain multi-head attention is used
+    # instead of the deformable one
+    embed_dims = 32
+    config = ConfigDict(
+        dict(
+            as_two_stage=True,
+            encoder=dict(
+                type='DetrTransformerEncoder',
+                num_layers=1,
+                transformerlayers=dict(
+                    type='BaseTransformerLayer',
+                    attn_cfgs=dict(
+                        type='MultiheadAttention',
+                        embed_dims=embed_dims,
+                        num_heads=8),
+                    feedforward_channels=64,
+                    ffn_cfgs=dict(type='FFN', embed_dims=embed_dims),
+                    operation_order=('self_attn', 'norm', 'ffn', 'norm'))),
+            decoder=dict(
+                type='DeformableDetrTransformerDecoder',
+                num_layers=1,
+                return_intermediate=True,
+                transformerlayers=dict(
+                    type='DetrTransformerDecoderLayer',
+                    attn_cfgs=dict(
+                        type='MultiheadAttention',
+                        embed_dims=embed_dims,
+                        num_heads=8),
+                    feedforward_channels=64,
+                    ffn_cfgs=dict(type='FFN', embed_dims=embed_dims),
+                    operation_order=('self_attn', 'norm', 'cross_attn', 'norm',
+                                     'ffn', 'norm')))))
+    transformer = DeformableDetrTransformer(**config)
+    transformer.init_weights()
+
+    spatial_shapes = ((16, 20), (8, 10), (4, 5), (2, 3))
+    # a different valid size per image, padded differently on every level
+    valid_hw = ((64, 80), (40, 52), (50, 30))
+    mlvl_masks = _padded_mlvl_masks(spatial_shapes, valid_hw)
+    mask_flatten = torch.cat([mask.flatten(1) for mask in mlvl_masks], 1)
+    assert mask_flatten.any() and not mask_flatten.all()
+
+    # valid ratios counted at once match the per level ones
+    valid_wh = transformer.get_valid_wh(mask_flatten, spatial_shapes)
+    level_wh = torch.tensor([(W, H) for H, W in spatial_shapes],
+                            dtype=torch.float32)
+    valid_ratios = valid_wh / level_wh
+    ref_valid_ratios = torch.stack(
+        [transformer.get_valid_ratio(mask) for mask in mlvl_masks], 1)
+    assert valid_ratios.shape == (len(valid_hw), len(spatial_shapes), 2)
+    assert torch.allclose(valid_ratios, ref_valid_ratios)
+    # the spatial shapes can also be given as a tensor
+    assert torch.equal(
+        transformer.get_valid_wh(mask_flatten,
+                                 torch.tensor(spatial_shapes)), valid_wh)
+
+    # reference points of the encoder
+    reference_points = transformer.get_reference_points(
+        spatial_shapes, valid_ratios, device=valid_ratios.device)
+    ref_reference_points = _ref_reference_points(spatial_shapes,
+                                                 ref_valid_ratios)
+    assert reference_points.shape == ref_reference_points.shape
+    assert torch.allclose(reference_points, ref_reference_points, atol=1e-6)
+
+    # proposals of the two-stage variant
+    memory = torch.rand(len(valid_hw), mask_flatten.size(1), embed_dims)
+    output_memory, output_proposals = \
+        transformer.gen_encoder_output_proposals(
+            memory, mask_flatten, torch.tensor(spatial_shapes))
+    ref_memory, ref_proposals = _ref_encoder_output_proposals(
+        memory, mask_flatten, spatial_shapes)
+    assert torch.isinf(ref_proposals).any()
+    assert torch.equal(
+        torch.isinf(output_proposals), torch.isinf(ref_proposals))
+    assert torch.allclose(output_proposals, ref_proposals, atol=1e-5)
+    ref_memory = transformer.enc_output_norm(
+        transformer.enc_output(ref_memory))
+    assert torch.allclose(output_memory, ref_memory, atol=1e-6)
+
+
+def _pix2seq_decoder_cfg(embed_dims=32, num_heads=4, num_layers=2):
+    return ConfigDict(
+        dict(
+            type='Pix2seqTransformerDecoder',
+            num_layers=num_layers,
+            post_norm_cfg=dict(type='LN'),
+            transformerlayers=dict(
+                type='Pix2seqTransformerDecoderLayer',
+                attn_cfgs=[
+                    dict(
+                        type='Pix2seqAttention',
+                        embed_dims=embed_dims,
+                        num_heads=num_heads),
+                    dict(
+                        type='MultiheadAttention',
+                        embed_dims=embed_dims,
+                        num_heads=num_heads)
+                ],
+                feedforward_channels=64,
+                ffn_cfgs=dict(type='FFN', embed_dims=embed_dims),
+                operation_order=('self_attn', 'norm', 'cross_attn', 'norm',
+                                 'ffn', 'norm'))))
+
+
+def _pix2seq_decoder(embed_dims=32, num_heads=4, num_layers=2):
+    config = _pix2seq_decoder_cfg(embed_dims, num_heads, num_layers)
+    config.pop('type')
+    decoder = Pix2seqTransformerDecoder(**config)
+    decoder.init_weights()
+    return decoder.eval()
+
+
+def _pix2seq_decoding_inputs(bs=2, embed_dims=32, num_steps=4, num_prefix=2):
+    """Encoder memory and the decoder inputs of every step, the first step
+    decodes a prefix of `num_prefix` tokens."""
+    num_keys = 12
+    memory = torch.rand(num_keys, bs, embed_dims)
+    pos = torch.rand(num_keys, bs, embed_dims)
+    memory_mask = torch.zeros(bs, num_keys, dtype=torch.bool)
+    memory_mask[1, 8:] = True
+    tgts = [torch.rand(num_prefix, bs, embed_dims)]
+    tgts += [torch.rand(1, bs, embed_dims) for _ in range(num_steps)]
+    return memory, pos, memory_mask, tgts
+
+
+def test_pix2seq_decoder_kv_cache():
+    bs, embed_dims, num_heads, num_layers = 2, 32, 4, 2
+    head_dim = embed_dims // num_heads
+    decoder = _pix2seq_decoder(embed_dims, num_heads, num_layers)
+    memory, pos, memory_mask, tgts = _pix2seq_decoding_inputs(bs, embed_dims)
+
+    max_len = 8
+    cache = decoder.init_kv_cache(bs, max_len, memory)
+    assert len(cache) == num_layers
+    for kv in cache:
+        assert kv.shape == (2, bs, num_heads, max_len, head_dim)
+        assert not kv.any()
+        # all the layers are views of one storage
+        assert kv._base is not None and kv._base is cache[0]._base
+
+    # the preallocated cache gives the same outputs as concatenating the
+    # keys and values of every step
+    concat_kv = [
+        memory.new_zeros((2, bs, num_heads, 0, head_dim))
+        for _ in range(num_layers)
+    ]
+    kv_len = 0
+    with torch.no_grad():
+        for tgt in tgts:
+            out, cache = decoder(
+                tgt,
+                memory,
+                memory_mask,
+                pos,
+                pre_kv_list=cache,
+                kv_len=kv_len)
+            ref_out, concat_kv = decoder(
+                tgt, memory, memory_mask, pos, pre_kv_list=concat_kv)
+            assert out.shape == (tgt.size(0), bs, embed_dims)
+            assert torch.allclose(out, ref_out, atol=1e-5)
+            kv_len += tgt.size(0)
+    for kv, ref_kv in zip(cache, concat_kv):
+        assert torch.allclose(kv[:, :, :, :kv_len], ref_kv, atol=1e-5)
+        assert not kv[:, :, :, kv_len:].any()
+
+
+def _ref_top_k_top_p_filtering(logits, top_k=0, top_p=0.0):
+    """The sort/shift/scatter implementation of `top_k_top_p_filtering`."""
+    filter_value = -float('Inf')
+    top_k = min(top_k, logits.size(-1))
+    if top_k > 0:
+        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1,
+                                                                   None]
+        logits[indices_to_remove] = filter_value
+    if top_p > 0.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        cumulative_probs = torch.cumsum(
+            F.softmax(sorted_logits, dim=-1), dim=-1)
+        sorted_indices_to_remove = cumulative_probs > top_p
+        sorted_indices_to_remove[..., 1:] = \
+            sorted_indices_to_remove[..., :-1].clone()
+        sorted_indices_to_remove[..., 0] = 0
+        indices_to_remove = sorted_indices[sorted_indices_to_remove]
+        logits[indices_to_remove] = filter_value
+    return logits
+
+
+def test_top_k_top_p_filtering():
+    generator = torch.Generator().manual_seed(0)
+    num_vocal = 100
+    randn = torch.randn(num_vocal, generator=generator)
+    perm = torch.randperm(num_vocal, generator=generator)
+    cases = [
+        # peaked distribution
+        dict(logits=randn * 5, top_p=0.9),
+        # flat distribution, without ties
+        dict(logits=torch.linspace(0, 0.1, num_vocal)[perm], top_p=0.5),
+        # top_p near 1 keeps all but the far tail
+        dict(logits=randn, top_p=0.99),
+        # top_k combined with top_p
+        dict(logits=randn * 2, top_k=10, top_p=0.8),
+        dict(logits=randn * 2, top_k=10, top_p=0.2),
+    ]
+    for case in cases:
+        logits = case.pop('logits')
+        # the two implementations take the softmax of the logits in a
+        # different order, the cumulative probabilities must be far enough
+        # from top_p for rounding not to change the kept tokens
+        probs = F.softmax(
+            _ref_top_k_top_p_filtering(logits.clone(), case.get('top_k', 0)),
+            dim=-1)
+        cumulative_probs = probs.sort(descending=True)[0].cumsum(-1)
+        assert (cumulative_probs - case['top_p']).abs().min() > 1e-4
+        out = top_k_top_p_filtering(logits.clone(), **case)
+        ref_out = _ref_top_k_top_p_filtering(logits.clone(), **case)
+        kept = torch.isfinite(out)
+        assert kept.any() and not kept.all()
+        assert torch.equal(kept, torch.isfinite(ref_out))
+        assert torch.equal(out[kept], logits[kept])
+
+    # the first token is kept even when it exceeds top_p alone
+    logits = torch.tensor([10., 0., -1., -2.])
+    out = top_k_top_p_filtering(logits.clone(), top_p=0.5)
+    assert torch.equal(torch.isfinite(out),
+                       torch.tensor([True, False, False, False]))
+
+    # tokens tied with the last kept one are all kept, the sort based
+    # implementation keeps an arbitrary subset of them
+    logits = torch.zeros(num_vocal)
+    out = top_k_top_p_filtering(logits.clone(), top_p=0.5)
+    assert torch.equal(out, logits)
+    ref_out = _ref_top_k_top_p_filtering(logits.clone(), top_p=0.5)
+    assert torch.isfinite(ref_out).sum() < num_vocal
+
+
+def test_sample_top_p(monkeypatch):
+    # the fused kernel is only used on CUDA, CPU logits take the fallback
+    def top_p_sampling_from_probs(probs, top_p):
+        raise AssertionError('the fused kernel needs CUDA logits')
+
+    monkeypatch.setattr(
+        'mmdet.models.utils.transformer.top_p_sampling_from_probs',
+        top_p_sampling_from_probs)
+    torch.manual_seed(0)
+    logits = torch.tensor([3., 2.5, 0., -1., -2.])
+    # the first two tokens hold ~0.96 of the probability
+    for _ in range(20):
+        token = sample_top_p(logits.clone(), top_p=0.8)
+        assert token.shape == (1, )
+        assert token.item() in (0, 1)
+
+
+def test_import_top_p_sampling(monkeypatch):
+
+    def fake_flashinfer(top_p_sampling_from_probs):
+        flashinfer = types.ModuleType('flashinfer')
+        flashinfer.sampling = types.ModuleType('flashinfer.sampling')
+        flashinfer.sampling.top_p_sampling_from_probs = \
+            top_p_sampling_from_probs
+        monkeypatch.setitem(sys.modules, 'flashinfer', flashinfer)
+        monkeypatch.setitem(sys.modules, 'flashinfer.sampling',
+                            flashinfer.sampling)
+
+    # flashinfer>=0.2 samples from the probabilities and top_p
+    def top_p_sampling_from_probs(probs, top_p, indices=None):
+        pass
+
+    fake_flashinfer(top_p_sampling_from_probs)
+    assert _import_top_p_sampling() is top_p_sampling_from_probs
+
+    # flashinfer<0.2 takes pre-drawn uniform samples
+    def old_top_p_sampling_from_probs(probs, uniform_samples, top_p):
+        pass
+
+    fake_flashinfer(old_top_p_sampling_from_probs)
+    assert _import_top_p_sampling() is None
+
+    # flashinfer is not installed
+    monkeypatch.setitem(sys.modules, 'flashinfer', None)
+    monkeypatch.setitem(sys.modules, 'flashinfer.sampling', None)
+    assert _import_top_p_sampling() is None
+
+
+def test_pix2seq_decoder_static_kv_cache():
+    bs, embed_dims, num_heads, num_layers = 2, 32, 4, 2
+    decoder = _pix2seq_decoder(embed_dims, num_heads, num_layers)
+    memory, pos, memory_mask, tgts = _pix2seq_decoding_inputs(bs, embed_dims)
+
+    max_len = 8
+    cache = decoder.init_kv_cache(bs, max_len, memory)
+    static_cache = decoder.init_kv_cache(
+        bs, max_len, memory, share_storage=False)
+    for kv in static_cache:
+        assert kv._base is None
+        # a cache reused across calls holds stale values, they must be
+        # masked by the decoding position
+        kv.normal_()
+
+    # a tensor `kv_len` attends the whole cache with the slots after the
+    # decoded tokens masked, which gives the same outputs as slicing with
+    # the prefix causally masked
+    kv_len = 0
+    kv_lens = torch.arange(max_len)
+    with torch.no_grad():
+        for seq_i, tgt in enumerate(tgts):
+            self_attn_mask = None
+            if seq_i == 0:
+                self_attn_mask = [
+                    torch.ones(len(tgt), len(tgt),
+                               dtype=torch.bool).triu(diagonal=1), None
+                ]
+            out, cache = decoder(
+                tgt,
+                memory,
+                memory_mask,
+                pos,
+                pre_kv_list=cache,
+                self_attn_mask=self_attn_mask,
+                kv_len=kv_len)
+            static_out, static_cache = decoder(
+                tgt,
+                memory,
+                memory_mask,
+                pos,
+                pre_kv_list=static_cache,
+                kv_len=kv_lens[kv_len])
+            assert torch.allclose(static_out, out, atol=1e-5)
+            kv_len += tgt.size(0)
+    for kv, static_kv in zip(cache, static_cache):
+        assert torch.allclose(
+            static_kv[:, :, :, :kv_len], kv[:, :, :, :kv_len], atol=1e-5)
+
+
+@pytest.mark.parametrize('num_prefix', [1, 3])
+def test_pix2seq_transformer_decode_sequences(num_prefix):
+    bs, embed_dims, num_heads, num_vocal, max_steps = 2, 32, 4, 20, 6
+    encoder = dict(
+        type='DetrTransformerEncoder',
+        num_layers=1,
+        transformerlayers=dict(
+            type='BaseTransformerLayer',
+            attn_cfgs=dict(
+                type='MultiheadAttention',
+                embed_dims=embed_dims,
+                num_heads=num_heads),
+            feedforward_channels=64,
+            ffn_cfgs=dict(type='FFN', embed_dims=embed_dims),
+            operation_order=('self_attn', 'norm', 'ffn', 'norm')))
+    transformer = Pix2seqTransformer(
+        encoder=ConfigDict(encoder),
+        decoder=_pix2seq_decoder_cfg(embed_dims, num_heads))
+    transformer.init_weights()
+    transformer.eval()
+    det_embed = nn.Embedding(num_prefix, embed_dims)
+    vocal_embed = nn.Embedding(num_vocal, embed_dims)
+    vocal_classifier = nn.Linear(embed_dims, num_vocal)
+    memory, pos, memory_mask, _ = _pix2seq_decoding_inputs(bs, embed_dims)
+
+    with torch.no_grad():
+        pred_seq_logits = transformer._decode_sequences(
+            memory, memory_mask, pos, det_embed, vocal_embed,
+            vocal_classifier, num_vocal,
+            lambda similarity: similarity[:, :, :num_vocal - 2].argmax(-1),
+            max_steps=max_steps)
+        pred_seq_logits = torch.stack(pred_seq_logits)
+        assert pred_seq_logits.shape == (bs, max_steps, num_vocal)
+
+        # decoding step by step gives the logits of decoding the whole
+        # causally masked sequence at once
+        tokens = pred_seq_logits[..., :num_vocal - 2].argmax(-1)
+        input_embed = torch.cat([
+            det_embed.weight.unsqueeze(0).expand(bs, -1, -1),
+            vocal_embed(tokens[:, :-1])
+        ], 1).transpose(0, 1)
+        num_seq = input_embed.size(0)
+        self_attn_mask = torch.ones(
+            num_seq, num_seq, dtype=torch.bool).triu(diagonal=1)
+        out_dec, _ = transformer.decoder(
+            input_embed,
+            memory,
+            memory_mask,
+            pos,
+            pre_kv_list=transformer.decoder.init_kv_cache(
+                bs, num_seq, memory),
+            self_attn_mask=[self_attn_mask, None],
+            kv_len=0)
+        ref_logits = vocal_classifier(out_dec[num_prefix - 1:])
+        assert torch.allclose(
+            pred_seq_logits, ref_logits.transpose(0, 1), atol=1e-5)